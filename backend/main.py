@@ -7,17 +7,25 @@ Startup Command:
     uvicorn main:app --reload --port 8000
 
 Or:
-    python main.py
+    python main.py            # Production: uvloop + httptools, WORKERS processes
+    DEV=1 python main.py      # Development: single process with auto-reload
+    LAZY_LOAD=1 ...           # Skip model preload/warm-up; load on first request
+
+Note: every worker process loads its own copy of all models,
+so memory usage scales with WORKERS.
 """
 
+import io
 import os
+import time
 import logging
 from contextlib import asynccontextmanager
 from typing import Optional, List
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
 # Configure logging
@@ -28,6 +36,11 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Upload limits for song classification
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024   # 20 MB
+UPLOAD_CHUNK_SIZE = 1 << 20           # Read uploads 1 MB at a time
+
+
 # ==================== Request/Response Models ====================
 
 class LyricsRequest(BaseModel):
@@ -37,6 +50,7 @@ class LyricsRequest(BaseModel):
     keywords: str = Field(default="", description="Keywords (optional)")
     num_words: int = Field(default=100, ge=20, le=1000, description="Number of words to generate")
     temperature: float = Field(default=0.8, ge=0.1, le=2.0, description="Generation temperature")
+    seed: Optional[int] = Field(default=None, ge=0, le=2**32 - 1, description="Sampling seed (optional); seeded requests are deterministic and cached")
 
 class LyricsResponse(BaseModel):
     """Lyrics generation response"""
@@ -51,17 +65,13 @@ class MelodyRequest(BaseModel):
     genre: str = Field(default="pop", description="Genre: pop, jazz, classical, rock")
     bars: int = Field(default=8, ge=4, le=32, description="Number of bars")
 
-class MelodyNote(BaseModel):
-    """Note data"""
-    pitch: int
-    step: float
-    duration: float
-    start_time: Optional[float] = None
-
 class MelodyResponse(BaseModel):
-    """Melody generation response"""
+    """Melody generation response (notes as parallel arrays, one entry per note)"""
     audio_url: str
-    notes: List[dict]
+    pitch: List[int]
+    step: List[float]
+    duration: List[float]
+    start_time: List[float]
     tempo: int
     genre: str
     bars: int
@@ -81,6 +91,38 @@ class ErrorResponse(BaseModel):
 
 # ==================== Application Lifecycle ====================
 
+async def _preload_services():
+    """Load all model services and warm them up"""
+    try:
+        from services import get_lyrics_service, get_melody_service, get_classification_service
+        lyrics_service = await run_in_threadpool(get_lyrics_service)
+        logger.info("✓ Lyrics Service initialized")
+        await run_in_threadpool(get_melody_service)
+        logger.info("✓ Melody Service initialized")
+        classification_service = await run_in_threadpool(get_classification_service)
+        logger.info("✓ Classification Service initialized")
+    except Exception as e:
+        logger.error(f"Error initializing services: {e}")
+        return
+    
+    # Warm up models so the first real request doesn't pay the cold-start cost
+    try:
+        start = time.perf_counter()
+        await run_in_threadpool(
+            lyrics_service.generate_lyrics, "love", "happy", num_words=20, temperature=0.8
+        )
+        logger.info(f"✓ Lyrics model warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logger.error(f"Lyrics warm-up failed: {e}")
+    
+    try:
+        start = time.perf_counter()
+        await run_in_threadpool(classification_service.warmup)
+        logger.info(f"✓ Classification model warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logger.error(f"Classification warm-up failed: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handle application startup and shutdown"""
@@ -89,14 +131,18 @@ async def lifespan(app: FastAPI):
     logger.info("🎵 Musify Backend Starting...")
     logger.info("=" * 50)
     
-    # Preload model services
     try:
-        from services import lyrics_service, melody_service, classification_service
-        logger.info("✓ Lyrics Service initialized")
-        logger.info("✓ Melody Service initialized")
-        logger.info("✓ Classification Service initialized")
+        from services import lyrics_batcher
+        await lyrics_batcher.start()
     except Exception as e:
-        logger.error(f"Error initializing services: {e}")
+        logger.error(f"Error starting lyrics batcher: {e}")
+    
+    # Preload model services (set LAZY_LOAD=1 to defer loading to the first request,
+    # e.g. for fast --reload cycles during development)
+    if os.environ.get("LAZY_LOAD"):
+        logger.info("LAZY_LOAD set, models will load on first request")
+    else:
+        await _preload_services()
     
     logger.info("=" * 50)
     logger.info("🚀 Musify Backend Ready!")
@@ -107,6 +153,11 @@ async def lifespan(app: FastAPI):
     
     # On shutdown
     logger.info("Musify Backend Shutting down...")
+    try:
+        from services import lyrics_batcher
+        await lyrics_batcher.stop()
+    except Exception as e:
+        logger.error(f"Error stopping lyrics batcher: {e}")
 
 
 # ==================== Create FastAPI App ====================
@@ -129,6 +180,7 @@ app = FastAPI(
     """,
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     responses={
         500: {"model": ErrorResponse, "description": "Internal Server Error"}
     }
@@ -149,7 +201,7 @@ app.add_middleware(
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     logger.error(f"Unhandled exception: {exc}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "Internal server error", "error_code": "INTERNAL_ERROR"}
     )
@@ -187,7 +239,7 @@ async def health_check():
     summary="Generate Lyrics",
     description="Generate creative lyrics based on theme, mood, and keywords"
 )
-def generate_lyrics(request: LyricsRequest):
+async def generate_lyrics(request: LyricsRequest):
     """
     🎤 Generate Lyrics
     
@@ -196,17 +248,21 @@ def generate_lyrics(request: LyricsRequest):
     - **keywords**: Keywords to include
     - **num_words**: Number of words to generate (20-200)
     - **temperature**: Creativity temperature, higher is more random (0.1-2.0)
+    - **seed**: Optional sampling seed for reproducible (cached) output
     """
     try:
-        from services import lyrics_service
+        from services import agenerate_lyrics
         
-        # Call generation service
-        generated = lyrics_service.generate_lyrics(
+        # Queue into the dynamic batcher (coalesces concurrent requests); the
+        # service is resolved in a worker thread, so a lazy model load never
+        # blocks the event loop
+        generated = await agenerate_lyrics(
             theme=request.theme,
             mood=request.mood,
             keywords=request.keywords,
             num_words=request.num_words,
-            temperature=request.temperature
+            temperature=request.temperature,
+            seed=request.seed
         )
         
         return LyricsResponse(
@@ -243,12 +299,12 @@ def generate_melody(request: MelodyRequest):
     
     Returns:
     - Audio playback URL
-    - Note sequence data (for visualization)
+    - Note sequence data as parallel arrays: pitch, step, duration, start_time
     """
     try:
-        from services import melody_service
+        from services import get_melody_service
         
-        result = melody_service.generate_melody(
+        result = get_melody_service().generate_melody(
             tempo=request.tempo,
             genre=request.genre,
             bars=request.bars
@@ -269,24 +325,27 @@ def generate_melody(request: MelodyRequest):
 @app.post(
     "/api/song-classification/predict",
     response_model=ClassificationResponse,
+    response_model_exclude_none=True,
     tags=["Song Classification"],
     summary="Predict Music Genre",
     description="Upload audio file, predict music genre using CNN model"
 )
 async def predict_genre(
-    file: UploadFile = File(..., description="Audio file (.wav, .mp3)")
+    file: UploadFile = File(..., description="Audio file (.wav, .mp3)"),
+    verbose: bool = Query(False, description="Include probabilities for all genres")
 ):
     """
     🎧 Music Genre Classification
     
     Upload an audio file, AI will analyze and predict its music genre.
     
-    Supported formats: WAV, MP3, FLAC, OGG, M4A
+    Supported formats: WAV, MP3, FLAC, OGG, M4A (max 20 MB)
     
     Returns:
     - Predicted top genre
     - Confidence score
     - Top-3 genre probability distribution
+    - All-genre probabilities (only with ?verbose=true)
     """
     try:
         # Validate file type
@@ -302,18 +361,27 @@ async def predict_genre(
                 detail=f"Unsupported file format. Allowed: {', '.join(allowed_extensions)}"
             )
         
-        # Read file content
-        file_bytes = await file.read()
+        # Stream file content with a hard size cap (reject oversized uploads early)
+        buf = io.BytesIO()
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            buf.write(chunk)
+            if buf.tell() > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large. Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+                )
         
-        if len(file_bytes) == 0:
+        if buf.tell() == 0:
             raise HTTPException(status_code=400, detail="Empty file")
         
+        file_bytes = buf.getvalue()
+        
         # Call classification service
-        from services import classification_service
-        from fastapi.concurrency import run_in_threadpool
+        from services import get_classification_service
         
-        # Run CPU-bound prediction in thread pool
-        result = await run_in_threadpool(classification_service.predict_genre, file_bytes)
+        # Run model load (first call only) and CPU-bound prediction in thread pool
+        classification_service = await run_in_threadpool(get_classification_service)
+        result = await run_in_threadpool(classification_service.predict_genre, file_bytes, verbose)
         
         return ClassificationResponse(**result)
         
@@ -350,10 +418,21 @@ if __name__ == "__main__":
     # Get port (supports environment variables)
     port = int(os.environ.get("PORT", 8000))
     
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=port,
-        reload=True,
-        log_level="info"
-    )
+    if os.environ.get("DEV"):
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=port,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=port,
+            workers=int(os.environ.get("WORKERS", os.cpu_count() or 1)),
+            loop="uvloop" if os.name != "nt" else "asyncio",  # uvloop has no Windows support
+            http="httptools",
+            log_level="info"
+        )
@@ -1,8 +1,9 @@
 # Musify Backend Services
 # This package contains the AI model service wrappers
+# Services are created lazily by their get_*_service() factories (cached singletons)
 
-from .lyrics_service import lyrics_service
-from .melody_service import melody_service
-from .classification_service import classification_service
+from .lyrics_service import get_lyrics_service, lyrics_batcher, agenerate_lyrics
+from .melody_service import get_melody_service
+from .classification_service import get_classification_service
 
-__all__ = ['lyrics_service', 'melody_service', 'classification_service']
+__all__ = ['get_lyrics_service', 'lyrics_batcher', 'agenerate_lyrics', 'get_melody_service', 'get_classification_service']
@@ -6,12 +6,20 @@ Reference: Song_Classification.ipynb
 
 import os
 import io
+import functools
+import hashlib
+import threading
 import numpy as np
 import logging
-from typing import Dict, Any, Tuple, Optional
+from typing import Callable, Dict, Any, Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
+try:
+    from cachetools import TTLCache
+except ImportError:
+    TTLCache = None
+
 # Model path configuration: points to models folder in project root
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 MODEL_DIR = os.path.join(PROJECT_ROOT, "models")
@@ -33,6 +41,15 @@ GENRES = {
 }
 
 
+@functools.lru_cache(maxsize=8)
+def _mel_filterbank(sr: int, n_fft: int, n_mels: int) -> np.ndarray:
+    """
+    Mel filterbank shared across calls (librosa rebuilds it inside every melspectrogram call)
+    """
+    import librosa
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+
+
 class ClassificationService:
     """
     Song Classification Service Class
@@ -48,10 +65,40 @@ class ClassificationService:
     HOP_LENGTH = 256
     N_MELS = 128
     
+    # ONNX Runtime inference path (falls back to Keras if unavailable)
+    USE_ONNX = True
+    ONNX_INT8 = True       # Dynamic int8 weight quantization
+    ONNX_OPSET = 17
+    
+    # Prediction cache (keyed on audio content hash)
+    CACHE_SIZE = 512
+    CACHE_TTL = 3600  # Seconds
+    
     def __init__(self):
         self.model = None
+        self._sess = None
+        self._infer = None
+        self._cache = TTLCache(maxsize=self.CACHE_SIZE, ttl=self.CACHE_TTL) if TTLCache else None
+        self._cache_lock = threading.Lock()
+        if self._cache is None:
+            logger.warning("cachetools not installed, classification cache disabled")
+        self._mel_fb, self._window = self._build_mel_basis()
         self._load_model()
     
+    def _build_mel_basis(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Precompute Mel filterbank and STFT window once
+        Matches librosa.feature.melspectrogram defaults (slaney mel, periodic Hann)
+        """
+        try:
+            from scipy.signal import windows
+            mel_fb = _mel_filterbank(self.SAMPLE_RATE, self.N_FFT, self.N_MELS)
+            window = windows.hann(self.N_FFT, sym=False)
+            return mel_fb, window
+        except Exception as e:
+            logger.error(f"Error building Mel filterbank: {e}")
+            return None, None
+    
     def _load_model(self):
         """
         Load pre-trained classification model
@@ -63,6 +110,7 @@ class ClassificationService:
                 from tensorflow.keras.models import load_model
                 self.model = load_model(model_path)
                 logger.info(f"Classification model loaded from {model_path}")
+                self._prepare_inference(model_path)
                 return
             
             # Attempt alternate path
@@ -75,6 +123,7 @@ class ClassificationService:
                 from tensorflow.keras.models import load_model
                 self.model = load_model(alt_path)
                 logger.info(f"Classification model loaded from {alt_path}")
+                self._prepare_inference(alt_path)
                 return
             
             logger.warning("Classification model not found, using demo mode")
@@ -83,12 +132,155 @@ class ClassificationService:
             logger.error(f"Error loading classification model: {e}")
             self.model = None
     
-    def predict_genre(self, file_bytes: bytes) -> Dict[str, Any]:
+    def _prepare_inference(self, keras_path: str):
+        """
+        Set up fast inference paths for the loaded Keras model
+        """
+        self._sess = self._load_onnx_session(keras_path)
+        if self._sess is None:
+            self._infer = self._build_infer_fn()
+    
+    def _build_infer_fn(self):
+        """
+        XLA-compiled forward pass (avoids Model.predict dispatch overhead)
+        """
+        try:
+            import tensorflow as tf
+            
+            model = self.model
+            
+            @tf.function(
+                input_signature=[tf.TensorSpec([None, self.N_MELS, None, 1], tf.float32)],
+                jit_compile=True
+            )
+            def infer(x):
+                return model(x, training=False)
+            
+            return infer
+        except Exception as e:
+            logger.warning(f"Could not build compiled inference function: {e}")
+            return None
+    
+    def _load_onnx_session(self, keras_path: str):
+        """
+        Export the Keras model to ONNX (cached next to the .keras file),
+        optionally int8-quantize it, and open an ONNX Runtime session.
+        Returns None if onnxruntime/tf2onnx are unavailable or export fails.
+        """
+        if not self.USE_ONNX:
+            return None
+        
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            logger.info("onnxruntime not installed, using Keras for classification")
+            return None
+        
+        base_path = os.path.splitext(keras_path)[0]
+        onnx_path = base_path + ".onnx"
+        int8_path = base_path + ".int8.onnx"
+        
+        def is_stale(path: str) -> bool:
+            return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(keras_path)
+        
+        def write_atomic(path: str, write: Callable[[str], None]):
+            # Every worker process may run this at startup: write to a
+            # per-process temp file and rename it into place, so no worker
+            # ever opens a half-written model
+            tmp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.onnx"
+            try:
+                write(tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        
+        try:
+            if is_stale(onnx_path):
+                import tensorflow as tf
+                import tf2onnx
+                
+                # tf2onnx.convert.from_keras does not handle Keras 3 models
+                # (tensorflow>=2.16), so export the traced forward pass instead
+                model = self.model
+                spec = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input"),)
+                
+                @tf.function(input_signature=spec)
+                def forward(x):
+                    return model(x, training=False)
+                
+                write_atomic(onnx_path, lambda out_path: tf2onnx.convert.from_function(
+                    forward,
+                    input_signature=spec,
+                    opset=self.ONNX_OPSET,
+                    output_path=out_path
+                ))
+                logger.info(f"Exported classification model to {onnx_path}")
+            
+            session_path = onnx_path
+            if self.ONNX_INT8:
+                try:
+                    if is_stale(int8_path):
+                        from onnxruntime.quantization import quantize_dynamic, QuantType
+                        write_atomic(int8_path, lambda out_path: quantize_dynamic(
+                            onnx_path, out_path, weight_type=QuantType.QInt8
+                        ))
+                        logger.info(f"Quantized classification model to {int8_path}")
+                    session_path = int8_path
+                except Exception as e:
+                    logger.warning(f"int8 quantization failed, using FP32 ONNX model: {e}")
+            
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess = ort.InferenceSession(
+                session_path,
+                sess_options=options,
+                providers=['CPUExecutionProvider']
+            )
+            logger.info(f"ONNX Runtime session ready ({session_path})")
+            return sess
+            
+        except Exception as e:
+            logger.warning(f"ONNX export/load failed, using Keras for classification: {e}")
+            return None
+    
+    def _run_model(self, specs: np.ndarray) -> np.ndarray:
+        """
+        Forward pass over a batch of spectrograms (ONNX Runtime, else Keras)
+        """
+        if self._sess is not None:
+            input_name = self._sess.get_inputs()[0].name
+            return self._sess.run(None, {input_name: specs.astype(np.float32)})[0]
+        
+        if self._infer is not None:
+            import tensorflow as tf
+            try:
+                return self._infer(tf.constant(specs, dtype=tf.float32)).numpy()
+            except Exception as e:
+                logger.warning(f"Compiled inference failed, falling back to predict: {e}")
+                self._infer = None
+        
+        return self.model.predict(specs, verbose=0)
+    
+    def warmup(self):
+        """
+        Run one dummy forward pass so graph setup / kernel autotuning
+        happens at startup instead of on the first user request.
+        The XLA-compiled path compiles once per input shape, so the dummy
+        goes through _process_audio to get the real per-song chunk batch.
+        """
+        if self.model is None:
+            return
+        dummy = self._process_audio(np.zeros(self.SONG_SAMPLES, dtype=np.float32))
+        self._run_model(dummy)
+    
+    def predict_genre(self, file_bytes: bytes, verbose: bool = False) -> Dict[str, Any]:
         """
         Predict music genre of audio file
         
         Args:
             file_bytes: Byte content of audio file
+            verbose: Also include probabilities for all genres
         
         Returns:
             Dictionary containing prediction results and probabilities
@@ -96,75 +288,101 @@ class ClassificationService:
         
         if self.model is not None:
             logger.info("Using real model for classification")
-            return self._predict_with_model(file_bytes)
+            return self._predict_with_model(file_bytes, verbose)
         else:
             logger.warning("Model not loaded, using demo mode for classification")
-            return self._predict_demo()
+            return self._predict_demo(verbose)
     
-    def _predict_with_model(self, file_bytes: bytes) -> Dict[str, Any]:
+    def _predict_with_model(self, file_bytes: bytes, verbose: bool = False) -> Dict[str, Any]:
         """
         Predict using real model
         """
+        cache_key = hashlib.blake2b(file_bytes, digest_size=16).digest()
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.info("Classification cache hit")
+            return self._format_predictions(cached, verbose=verbose)
+        
         try:
             import librosa
-            import soundfile as sf
             
-            # Load audio
+            # Load audio (first 30s, float32 mono)
             signal, sr = self._load_audio(file_bytes)
             if signal is None:
                 raise ValueError("Failed to load audio file")
             
-            # Resample (if needed)
+            # Resample (if needed) - polyphase is much faster than the default soxr/kaiser
             if sr != self.SAMPLE_RATE:
-                signal = librosa.resample(signal, orig_sr=sr, target_sr=self.SAMPLE_RATE)
+                signal = librosa.resample(
+                    signal, orig_sr=sr, target_sr=self.SAMPLE_RATE, res_type='polyphase'
+                )
             
-            # Convert to mono
-            if len(signal.shape) > 1:
-                signal = np.mean(signal, axis=1)
-            
-            # Ensure sufficient length
-            if len(signal) < self.SONG_SAMPLES:
-                # Pad
-                signal = np.pad(signal, (0, self.SONG_SAMPLES - len(signal)))
-            else:
-                signal = signal[:self.SONG_SAMPLES]
+            # Ensure fixed length: copy into a zeroed float32 buffer (pads short audio)
+            buf = np.zeros(self.SONG_SAMPLES, dtype=np.float32)
+            n = min(len(signal), self.SONG_SAMPLES)
+            buf[:n] = signal[:n]
+            signal = buf
             
             # Split and convert to spectrograms
             specs = self._process_audio(signal)
             
             # Batch prediction
-            predictions = self.model.predict(specs, verbose=0)
+            predictions = self._run_model(specs)
             
             # Aggregate predictions (average over all segments)
             avg_predictions = np.mean(predictions, axis=0)
             
             # Get top-k results
-            return self._format_predictions(avg_predictions)
+            self._cache_set(cache_key, avg_predictions)
+            return self._format_predictions(avg_predictions, verbose=verbose)
             
         except Exception as e:
             logger.error(f"Prediction error: {e}")
             # Return demo results on error
-            return self._predict_demo()
+            return self._predict_demo(verbose)
+    
+    def _cache_get(self, key: bytes) -> Optional[np.ndarray]:
+        """Look up cached averaged probabilities (TTLCache is not thread-safe)"""
+        if self._cache is None:
+            return None
+        with self._cache_lock:
+            return self._cache.get(key)
+    
+    def _cache_set(self, key: bytes, result: np.ndarray):
+        """Store averaged probabilities (formatted per request, so verbose and compact share entries)"""
+        if self._cache is None:
+            return
+        with self._cache_lock:
+            self._cache[key] = result
     
     def _load_audio(self, file_bytes: bytes) -> Tuple[Optional[np.ndarray], Optional[int]]:
         """
         Load audio from byte stream
+        Only the first 30 seconds are decoded, directly as float32 mono
         """
         import librosa
         import soundfile as sf
         
+        duration = self.SONG_SAMPLES / self.SAMPLE_RATE  # 30 seconds
+        
         try:
             # Try using soundfile
             audio_io = io.BytesIO(file_bytes)
-            signal, sr = sf.read(audio_io)
+            with sf.SoundFile(audio_io) as f:
+                sr = f.samplerate
+                signal = f.read(frames=int(duration * sr), dtype='float32', always_2d=False)
+            
+            # Convert to mono
+            if signal.ndim > 1:
+                signal = signal.mean(axis=1, dtype=np.float32)
             return signal, sr
         except Exception:
             pass
         
         try:
-            # Try using librosa
+            # Try using librosa (mono by default)
             audio_io = io.BytesIO(file_bytes)
-            signal, sr = librosa.load(audio_io, sr=None)
+            signal, sr = librosa.load(audio_io, sr=None, mono=True, duration=duration, dtype=np.float32)
             return signal, sr
         except Exception as e:
             logger.error(f"Failed to load audio: {e}")
@@ -174,64 +392,70 @@ class ClassificationService:
         """
         Process audio signal into Mel spectrogram
         Reference: splitsongs and to_melspectrogram in Song_Classification.ipynb
-        """
-        import librosa
         
+        All chunks go through one batched STFT (framing + rfft + filterbank
+        matmul) instead of a per-chunk librosa call. Framing matches librosa's
+        stft defaults: center=True with zero padding of n_fft // 2.
+        """
         # Split parameters (Consistent with Notebook)
         chunk_size = int(len(signal) * self.WINDOW_SIZE)  # 660000 * 0.05 = 33000
         offset = int(chunk_size * (1 - self.OVERLAP))     # 33000 * 0.5 = 16500
         
-        # Split audio (splitsongs)
-        chunks = []
-        for i in range(0, len(signal) - chunk_size + offset, offset):
-            chunk = signal[i:i + chunk_size]
-            if len(chunk) == chunk_size:
-                chunks.append(chunk)
+        # Split audio (splitsongs): zero-copy strided views of every full-length chunk
+        chunks = np.lib.stride_tricks.sliding_window_view(signal, chunk_size)[::offset]
         
         logger.info(f"Split audio into {len(chunks)} chunks")
         
         # Convert to Mel spectrogram (to_melspectrogram)
         # Note: No amplitude_to_db conversion in Notebook!
-        specs = []
-        for chunk in chunks:
-            mel_spec = librosa.feature.melspectrogram(
-                y=chunk.astype(np.float32),
-                sr=self.SAMPLE_RATE,
-                n_fft=self.N_FFT,
-                hop_length=self.HOP_LENGTH,
-                n_mels=self.N_MELS
-            )
-            # Add channel dimension [:,:,np.newaxis] - Consistent with Notebook
-            specs.append(mel_spec[:, :, np.newaxis])
+        pad = self.N_FFT // 2
+        padded = np.pad(chunks.astype(np.float32, copy=False), ((0, 0), (pad, pad)))  # [B, chunk_size + n_fft]
+        
+        # [B, n_frames, N_FFT] strided view, no copy until the window multiply
+        frames = np.lib.stride_tricks.sliding_window_view(
+            padded, self.N_FFT, axis=-1
+        )[:, ::self.HOP_LENGTH]
+        
+        spectrum = np.fft.rfft(frames * self._window, axis=-1)    # [B, n_frames, 1 + N_FFT/2]
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
         
-        return np.array(specs)
+        # [n_mels, freq] x [B, frames, freq] -> [B, n_mels, frames]
+        mel_specs = np.einsum('mf,btf->bmt', self._mel_fb, power)
+        
+        # Add channel dimension [..., np.newaxis] - Consistent with Notebook
+        return mel_specs[..., np.newaxis]
     
-    def _format_predictions(self, predictions: np.ndarray, top_k: int = 3) -> Dict[str, Any]:
+    def _format_predictions(self, predictions: np.ndarray, top_k: int = 3, verbose: bool = False) -> Dict[str, Any]:
         """
         Format prediction results
+        all_genres is only built when verbose is requested
         """
-        # Get sorted indices
-        sorted_indices = np.argsort(predictions)[::-1]
+        # Partial sort: select top-k in O(n), then order only those k
+        top_k = min(top_k, len(predictions))
+        idx = np.argpartition(predictions, -top_k)[-top_k:]
+        idx = idx[np.argsort(predictions[idx])[::-1]]
         
         # Main prediction
-        top_genre = GENRES[sorted_indices[0]]
+        top_genre = GENRES[int(idx[0])]
         
         # Top-k probabilities
         probabilities = {}
-        for i in range(min(top_k, len(sorted_indices))):
-            idx = sorted_indices[i]
-            genre_name = GENRES[idx]
-            prob = float(predictions[idx])
+        for i in idx:
+            genre_name = GENRES[int(i)]
+            prob = float(predictions[i])
             probabilities[genre_name] = round(prob, 4)
         
         return {
             "top_genre": top_genre,
-            "confidence": round(float(predictions[sorted_indices[0]]), 4),
+            "confidence": round(float(predictions[idx[0]]), 4),
             "probabilities": probabilities,
-            "all_genres": {GENRES[i]: round(float(p), 4) for i, p in enumerate(predictions)}
+            "all_genres": (
+                {GENRES[i]: round(float(p), 4) for i, p in enumerate(predictions)}
+                if verbose else None
+            )
         }
     
-    def _predict_demo(self) -> Dict[str, Any]:
+    def _predict_demo(self, verbose: bool = False) -> Dict[str, Any]:
         """
         Demo Mode: Return simulated prediction results
         """
@@ -241,12 +465,23 @@ class ClassificationService:
         # Use Dirichlet distribution to generate probabilities
         probs = np.random.dirichlet(np.ones(len(GENRES)) * 0.5)
         
-        return self._format_predictions(probs)
+        return self._format_predictions(probs, verbose=verbose)
     
     def get_supported_formats(self) -> list:
         """Return supported audio formats"""
         return ['.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac']
 
 
-# Create global service instance
-classification_service = ClassificationService()
+# Global service instance (model loads lazily on first call; the lock keeps
+# concurrent first requests from loading the model twice)
+_classification_service: Optional[ClassificationService] = None
+_classification_service_lock = threading.Lock()
+
+
+def get_classification_service() -> ClassificationService:
+    global _classification_service
+    if _classification_service is None:
+        with _classification_service_lock:
+            if _classification_service is None:
+                _classification_service = ClassificationService()
+    return _classification_service
@@ -4,10 +4,13 @@ Uses local fine-tuned GPT-2 model for lyrics generation.
 """
 
 import os
+import asyncio
 import logging
 import torch
 import re
-from typing import Dict
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -22,16 +25,59 @@ POSSIBLE_MODEL_PATHS = [
     os.path.join(PROJECT_ROOT, "gpt2_lyrics", "final_model"),      # Finally try fine-tuned output in root directory
 ]
 
+def _cpu_supports_bf16() -> bool:
+    """Check for native BF16 instructions (AVX512-BF16 / AMX) on Linux."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        return False
+
+
+# Output-cleaning patterns (compiled once, used by LyricsService._clean_output)
+_ARTIFACT_RE = re.compile(
+    '|'.join([
+        r'externalToEVA',
+        r'rawdownload',
+        r'embedreportprint',
+        r'http\S+',
+        r'www\.\S+',
+    ]),
+    re.IGNORECASE
+)
+_NONPRINT_RE = re.compile(r'[^a-zA-Z0-9\s.,!?\'\"\-;:\n]')
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+_MULTI_SPACE_RE = re.compile(r' {2,}')
+_SPACE_BEFORE_PUNCT_RE = re.compile(r'\s+([,.!?;:])')
+_SECTION_MARKER_RE = re.compile(r'[\(\[\{].*?(repeat|chorus|verse|bridge|hook).*?[\)\]\}]', re.IGNORECASE)
+_REPEAT_COUNT_RE = re.compile(r'\bx\s?\d+\b', re.IGNORECASE)
+_REPEAT_LABEL_RE = re.compile(r'\b(repeat|chorus)\s+\d+x\b', re.IGNORECASE)
+_DANGLING_RE = re.compile(r'[xX\(\)\[\]]')
+
+
 class LyricsService:
     """
     GPT-2 based lyrics generation service.
     """
     
+    # Max number of seeded (deterministic) results kept in memory
+    CACHE_SIZE = 1024
+    # Wrap the model with torch.compile (PyTorch 2.x); off by default as
+    # compile time is long and generate() support varies between versions
+    USE_TORCH_COMPILE = False
+    
     def __init__(self):
         self.model = None
         self.tokenizer = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model_path: str = "unknown"
+        # generate() samples from the global torch RNG: every call holds this lock,
+        # and seeded runs hold it across manual_seed + generate, so no concurrent
+        # batch can consume random numbers in between (re-entrant for that reason)
+        self._generate_lock = threading.RLock()
+        self._generate_seeded = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._generate_seeded_uncached)
+        self._tokenize_prefix = functools.lru_cache(maxsize=256)(self._tokenize_prefix_uncached)
         self._load_model()
     
     def _load_model(self) -> bool:
@@ -71,11 +117,25 @@ class LyricsService:
             
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Decoder-only batched generation needs left padding
+            self.tokenizer.padding_side = 'left'
             
             self.model.to(self.device)
             self.model.eval()
             
-            logger.info(f"GPT-2 loaded successfully from '{self.model_path}' on {self.device}")
+            # Reduced precision: FP16 on GPU, BF16 on CPUs with native BF16 support
+            if self.device.type == 'cuda':
+                self.model = self.model.half()
+            elif _cpu_supports_bf16():
+                self.model = self.model.to(dtype=torch.bfloat16)
+            
+            if self.USE_TORCH_COMPILE and hasattr(torch, 'compile'):
+                try:
+                    self.model = torch.compile(self.model, mode='reduce-overhead')
+                except Exception as e:
+                    logger.warning(f"torch.compile unavailable, using eager model: {e}")
+            
+            logger.info(f"GPT-2 loaded successfully from '{self.model_path}' on {self.device} ({self.model.dtype})")
             return True
             
         except ImportError:
@@ -92,6 +152,7 @@ class LyricsService:
         keywords: str = "",
         num_words: int = 300,
         temperature: float = 0.9,
+        seed: Optional[int] = None,
         **kwargs
     ) -> str:
         """
@@ -103,44 +164,123 @@ class LyricsService:
             keywords: Optional keywords.
             num_words: Target word count.
             temperature: Sampling temperature (higher = more creative).
+            seed: Optional sampling seed. Seeded output is deterministic and
+                therefore served from an LRU cache on repeat requests.
         
         Returns:
             Generated lyrics text.
         """
+        if seed is not None and self.model is not None and not kwargs:
+            try:
+                return self._generate_seeded(theme, mood, keywords, num_words, temperature, seed)
+            except Exception as e:
+                logger.error(f"Generation failed: {e}")
+                return self._demo_lyrics(theme, mood, keywords)
+        
+        request = {
+            'theme': theme,
+            'mood': mood,
+            'keywords': keywords,
+            'num_words': num_words,
+            'temperature': temperature,
+        }
+        return self.generate_lyrics_batch([request], **kwargs)[0]
+    
+    def generate_lyrics_batch(self, requests: List[Dict[str, Any]], **kwargs) -> List[str]:
+        """
+        Generate lyrics for several requests with a single padded generate() call.
+        
+        Args:
+            requests: Request dicts (theme, mood, keywords, num_words, temperature).
+                All requests must share num_words and temperature; LyricsBatcher
+                groups them that way before calling.
+        
+        Returns:
+            Generated lyrics text, one entry per request (same order).
+        """
         if self.model is None:
-            return self._demo_lyrics(theme, mood, keywords)
+            return [self._demo_lyrics(r['theme'], r['mood'], r.get('keywords', '')) for r in requests]
         
         try:
-            prompt = self._build_prompt(theme, mood, keywords)
-            logger.info(f"Generating with prompt: {prompt[:80]}...")
-            
-            inputs = self.tokenizer(prompt, return_tensors='pt').to(self.device)
-            max_new_tokens = int(num_words * 1.3)
-            
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs['input_ids'],
-                    max_new_tokens=max_new_tokens,
-                    min_new_tokens=100,
-                    temperature=temperature,
-                    top_k=kwargs.get('top_k', 50),
-                    top_p=kwargs.get('top_p', 0.95),
-                    repetition_penalty=kwargs.get('repetition_penalty', 1.2),
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    early_stopping=True,
-                )
-            
-            generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            generated_text = self._clean_output(generated_text)
-            
-            logger.info("Generation successful")
-            return generated_text
-            
+            return self._generate_batch(requests, **kwargs)
         except Exception as e:
             logger.error(f"Generation failed: {e}")
-            return self._demo_lyrics(theme, mood, keywords)
+            return [self._demo_lyrics(r['theme'], r['mood'], r.get('keywords', '')) for r in requests]
+    
+    def _generate_seeded_uncached(
+        self,
+        theme: str,
+        mood: str,
+        keywords: str,
+        num_words: int,
+        temperature: float,
+        seed: int
+    ) -> str:
+        """Seeded single-request generation (wrapped by an LRU cache in __init__)."""
+        request = {
+            'theme': theme,
+            'mood': mood,
+            'keywords': keywords,
+            'num_words': num_words,
+            'temperature': temperature,
+        }
+        with self._generate_lock:
+            torch.manual_seed(seed)
+            return self._generate_batch([request])[0]
+    
+    def _generate_batch(self, requests: List[Dict[str, Any]], **kwargs) -> List[str]:
+        """Run one padded generate() call. Raises on failure."""
+        prompts = [self._build_prompt(r['theme'], r['mood'], r.get('keywords', '')) for r in requests]
+        logger.info(f"Generating batch of {len(prompts)}, first prompt: {prompts[0][:80]}...")
+        
+        # Prompt header is cached per (theme, mood); only keywords are tokenized
+        # per request, in one tokenizer call for the whole batch. Left padding
+        # (set at load time) keeps every prompt ending where generation starts.
+        keyword_ids = self.tokenizer(
+            [r.get('keywords', '').capitalize() for r in requests]
+        )['input_ids']
+        input_ids = [
+            list(self._tokenize_prefix(r['theme'], r['mood'])) + ids
+            for r, ids in zip(requests, keyword_ids)
+        ]
+        inputs = self.tokenizer.pad(
+            {'input_ids': input_ids}, padding=True, return_tensors='pt'
+        ).to(self.device)
+        
+        max_new_tokens = int(requests[0]['num_words'] * 1.3)
+        
+        with self._generate_lock, torch.no_grad():
+            outputs = self.model.generate(
+                inputs['input_ids'],
+                attention_mask=inputs['attention_mask'],
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=100,
+                temperature=requests[0]['temperature'],
+                top_k=kwargs.get('top_k', 50),
+                top_p=kwargs.get('top_p', 0.95),
+                repetition_penalty=kwargs.get('repetition_penalty', 1.2),
+                do_sample=True,
+                use_cache=True,
+                pad_token_id=self.tokenizer.eos_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                early_stopping=True,
+            )
+        
+        generated = [
+            self._clean_output(self.tokenizer.decode(row, skip_special_tokens=True))
+            for row in outputs
+        ]
+        
+        logger.info("Generation successful")
+        return generated
+    
+    def _tokenize_prefix_uncached(self, theme: str, mood: str) -> Tuple[int, ...]:
+        """
+        Token ids of the prompt header (wrapped by an LRU cache in __init__).
+        The header ends with a newline, which GPT-2's pre-tokenizer always splits
+        on, so header + keyword ids equal the ids of the full prompt.
+        """
+        return tuple(self.tokenizer(self._build_prompt(theme, mood, ""))['input_ids'])
     
     def _build_prompt(self, theme: str, mood: str, keywords: str) -> str:
         """Build prompt for GPT-2."""
@@ -159,33 +299,25 @@ class LyricsService:
         # Force ASCII to remove unicode artifacts like ÃÂÃÂ, , 
         text = text.encode('ascii', 'ignore').decode('ascii')
         
-        # Remove specific dataset artifacts
-        artifacts = [
-            r'externalToEVA', 
-            r'rawdownload', 
-            r'embedreportprint',
-            r'http\S+',
-            r'www\.\S+'
-        ]
-        for artifact in artifacts:
-            text = re.sub(artifact, '', text, flags=re.IGNORECASE)
+        # Remove specific dataset artifacts (single pass over one alternation)
+        text = _ARTIFACT_RE.sub('', text)
 
         # Remove control characters and non-standard punctuation
         # Keep only alphanumeric, basic punctuation, and newlines
-        text = re.sub(r'[^a-zA-Z0-9\s.,!?\'\"\-;:\n]', '', text)
+        text = _NONPRINT_RE.sub('', text)
 
         # 1. Remove excess empty lines
-        text = re.sub(r'\n{3,}', '\n\n', text)
+        text = _MULTI_NEWLINE_RE.sub('\n\n', text)
         
         # 2. Fix spaces before punctuation (e.g., "hello , world" -> "hello, world")
-        text = re.sub(r' {2,}', ' ', text)
-        text = re.sub(r'\s+([,.!?;:])', r'\1', text)
+        text = _MULTI_SPACE_RE.sub(' ', text)
+        text = _SPACE_BEFORE_PUNCT_RE.sub(r'\1', text)
         
         # 3. Remove common lyrics metadata markers (x2, x3, repeat, chorus, etc.)
         # Match: x2, x 2, (x2), [repeat], (chorus), etc.
-        text = re.sub(r'[\(\[\{].*?(repeat|chorus|verse|bridge|hook).*?[\)\]\}]', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'\bx\s?\d+\b', '', text, flags=re.IGNORECASE) # Remove x2, x 4
-        text = re.sub(r'\b(repeat|chorus)\s+\d+x\b', '', text, flags=re.IGNORECASE)
+        text = _SECTION_MARKER_RE.sub('', text)
+        text = _REPEAT_COUNT_RE.sub('', text) # Remove x2, x 4
+        text = _REPEAT_LABEL_RE.sub('', text)
         
         # 4. Remove dangling characters at end of lines (e.g., last line only "x" or "and")
         lines = text.split('\n')
@@ -193,7 +325,7 @@ class LyricsService:
         for line in lines:
             line = line.strip()
             # If a line is too short and contains strange characters, discard
-            if len(line) < 3 and re.search(r'[xX\(\)\[\]]', line):
+            if len(line) < 3 and _DANGLING_RE.search(line):
                 continue
             if line:
                 cleaned_lines.append(line)
@@ -235,5 +367,179 @@ Forever in your embrace
         }
 
 
-# Global service instance
-lyrics_service = LyricsService()
+class LyricsBatcher:
+    """
+    Dynamic request batcher for lyrics generation.
+    
+    Concurrent requests arriving within a short window are coalesced and run
+    through one padded generate() call (TF-Serving/Triton style). Requests are
+    grouped by (num_words, temperature) since generate() takes them as scalars,
+    and bucketed by prompt length to keep left-padding waste small.
+    """
+    
+    MAX_BATCH_SIZE = 8
+    MAX_BATCH_DELAY = 0.02      # Seconds to wait for more requests after the first
+    LENGTH_BUCKET_CHARS = 32    # Prompts within the same 32-char band share a batch
+    
+    def __init__(self, service_factory: Callable[[], LyricsService]):
+        # Resolved inside worker threads so a lazy model load never blocks the event loop
+        self.service_factory = service_factory
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Start the background batching worker (call from the app lifespan)."""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        logger.info(
+            f"Lyrics batcher started (max_batch_size={self.MAX_BATCH_SIZE}, "
+            f"max_batch_delay={self.MAX_BATCH_DELAY * 1000:.0f}ms)"
+        )
+    
+    async def stop(self):
+        """Stop the background worker."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._queue = None
+    
+    async def submit(
+        self,
+        theme: str,
+        mood: str,
+        keywords: str = "",
+        num_words: int = 300,
+        temperature: float = 0.9,
+        seed: Optional[int] = None
+    ) -> str:
+        """
+        Queue a generation request and wait for its result.
+        Falls back to a direct (unbatched) call when the worker is not running.
+        Seeded requests always bypass the queue: their output must not depend on
+        which other requests happen to share the batch, and they are LRU-cached.
+        """
+        loop = asyncio.get_running_loop()
+        
+        if seed is not None:
+            return await loop.run_in_executor(
+                None,
+                lambda: self.service_factory().generate_lyrics(
+                    theme, mood, keywords, num_words, temperature, seed=seed
+                )
+            )
+        
+        request = {
+            'theme': theme,
+            'mood': mood,
+            'keywords': keywords,
+            'num_words': num_words,
+            'temperature': temperature,
+        }
+        
+        if self._worker is None:
+            results = await loop.run_in_executor(None, self._generate_batch, [request])
+            return results[0]
+        
+        future = loop.create_future()
+        await self._queue.put((request, future))
+        return await future
+    
+    async def _collect(self) -> List[Tuple[Dict[str, Any], asyncio.Future]]:
+        """Wait for one request, then drain more until the batch is full or the window closes."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.MAX_BATCH_DELAY
+        
+        while len(batch) < self.MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    def _generate_batch(self, requests: List[Dict[str, Any]]) -> List[str]:
+        return self.service_factory().generate_lyrics_batch(requests)
+    
+    def _bucket_key(self, request: Dict[str, Any]) -> tuple:
+        prompt_len = len(request['theme']) + len(request['mood']) + len(request['keywords'])
+        return (request['num_words'], request['temperature'], prompt_len // self.LENGTH_BUCKET_CHARS)
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = await self._collect()
+            
+            buckets: Dict[tuple, List[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+            for request, future in batch:
+                buckets.setdefault(self._bucket_key(request), []).append((request, future))
+            
+            for jobs in buckets.values():
+                requests = [request for request, _ in jobs]
+                try:
+                    results = await loop.run_in_executor(
+                        None, self._generate_batch, requests
+                    )
+                except Exception as e:
+                    logger.error(f"Batched generation failed: {e}")
+                    for _, future in jobs:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                
+                for (_, future), result in zip(jobs, results):
+                    # Client may have disconnected and cancelled the future
+                    if not future.done():
+                        future.set_result(result)
+
+
+# Global service instance (model loads lazily on first call; the lock keeps
+# concurrent first requests from loading the model twice)
+_lyrics_service: Optional[LyricsService] = None
+_lyrics_service_lock = threading.Lock()
+
+
+def get_lyrics_service() -> LyricsService:
+    global _lyrics_service
+    if _lyrics_service is None:
+        with _lyrics_service_lock:
+            if _lyrics_service is None:
+                _lyrics_service = LyricsService()
+    return _lyrics_service
+
+
+lyrics_batcher = LyricsBatcher(get_lyrics_service)
+
+
+async def agenerate_lyrics(
+    theme: str,
+    mood: str,
+    keywords: str = "",
+    num_words: int = 300,
+    temperature: float = 0.9,
+    seed: Optional[int] = None
+) -> str:
+    """
+    Async entry point for request handlers: queues the request into the
+    dynamic batcher so concurrent calls share one generate() pass on the
+    global service.
+    """
+    return await lyrics_batcher.submit(
+        theme=theme,
+        mood=mood,
+        keywords=keywords,
+        num_words=num_words,
+        temperature=temperature,
+        seed=seed
+    )
@@ -32,11 +32,19 @@ import numpy as np
 import logging
 from typing import List, Dict, Any, Optional
 import json
+import functools
+import struct
+import threading
 
 import tensorflow as tf
 
 logger = logging.getLogger(__name__)
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # Model path configuration
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 MODEL_DIR = os.path.join(PROJECT_ROOT, "models")
@@ -65,45 +73,233 @@ except AttributeError:
         pass
 
 
+def clone_with_precision(model, policy: str):
+    """
+    Rebuild a functional Keras model with its hidden layers under the given
+    dtype policy ('float32' or 'mixed_float16') and copy the weights over
+    (variables are float32 under both policies). Output heads stay float32
+    so sampling always runs in full precision.
+    """
+    output_names = set(model.output_names)
+    config = model.get_config()
+    
+    for layer in config['layers']:
+        if layer['class_name'] == 'InputLayer':
+            continue
+        name = layer['config']['name']
+        layer['config']['dtype'] = 'float32' if name in output_names else policy
+    
+    clone = model.__class__.from_config(config)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
 # ============================================================================
 # 2. Prediction Function (Copied from Notebook)
 # ============================================================================
 
+def gumbel_max_sample(logits: tf.Tensor) -> tf.Tensor:
+    """
+    Draw one categorical sample per row via the Gumbel-max trick:
+    argmax(logits + Gumbel(0, 1)) has the same distribution as
+    tf.random.categorical(logits), without normalizing the logits.
+    
+    Returns int32 indices, shape logits.shape[:-1].
+    """
+    uniform = tf.random.uniform(tf.shape(logits), minval=1e-9, maxval=1.0)
+    gumbel = -tf.math.log(-tf.math.log(uniform))
+    return tf.argmax(logits + gumbel, axis=-1, output_type=tf.int32)
+
+
+def make_sample_fn(model, seq_length: int, vocab_size: int = 128, jit_compile: bool = False):
+    """
+    Build the fused per-step sampler: model forward + temperature scaling +
+    scale-masked Gumbel-max sampling + non-negative clamp in a single graph call.
+    With jit_compile=True, XLA fuses the whole step into one compiled kernel.
+    
+    Temperature and scale bias are tensor arguments, so switching between values
+    does not retrace. Returns a float32 tensor [pitch, step, duration] so the
+    caller needs one .numpy() sync.
+    """
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec((1, seq_length, 3), tf.float32),
+            tf.TensorSpec((), tf.float32),
+            tf.TensorSpec((vocab_size,), tf.float32),     # MusicTheory.get_scale_bias
+        ],
+        jit_compile=jit_compile,
+        reduce_retracing=True
+    )
+    def sample(notes, temperature, scale_bias):
+        predictions = model(notes, training=False)
+        
+        # Pitch: sample after temperature scaling, restricted to scale
+        pitch_logits = tf.cast(predictions['pitch'], tf.float32) / temperature + scale_bias
+        pitch = gumbel_max_sample(pitch_logits)
+        
+        # Step and Duration: regression output, clamped non-negative
+        step = tf.maximum(tf.squeeze(predictions['step'], axis=-1), 0.0)
+        duration = tf.maximum(tf.squeeze(predictions['duration'], axis=-1), 0.0)
+        
+        return tf.stack([
+            tf.cast(pitch[0], tf.float32),
+            tf.cast(step[0], tf.float32),
+            tf.cast(duration[0], tf.float32),
+        ])
+    
+    return sample
+
+
 def predict_next_note(
     notes: np.ndarray,
-    model,
-    temperature: float = 1.0
+    sample_fn,
+    temperature: float = 1.0,
+    scale_bias: Optional[tf.Tensor] = None
 ) -> tuple:
     """
-    Prediction function directly copied from Music_Generation.ipynb
+    Prediction function adapted from Music_Generation.ipynb
     
     Args:
         notes: Input sequence shape (1, seq_length, 3)
-        model: Trained model
+        sample_fn: Fused sampler from make_sample_fn
         temperature: Sampling temperature
+        scale_bias: Logit bias from MusicTheory.get_scale_bias (None = no key constraint)
     
     Returns:
         tuple: (pitch, step, duration)
     """
     assert temperature > 0, "Temperature must be greater than 0"
     
-    # Model prediction
-    predictions = model.predict(notes, verbose=0)
+    if scale_bias is None:
+        scale_bias = tf.zeros(sample_fn.input_signature[2].shape, tf.float32)
+    
+    result = sample_fn(
+        tf.constant(notes, dtype=tf.float32),
+        tf.constant(temperature, dtype=tf.float32),
+        scale_bias
+    ).numpy()
+    
+    return int(result[0]), float(result[1]), float(result[2])
+
+
+def _post_step_py(
+    pitch: int,
+    step: float,
+    duration: float,
+    grid: float,
+    inv_norm: np.ndarray,
+    window: np.ndarray,
+    out: np.ndarray
+):
+    """
+    One stepwise post-processing pass, written as plain loops for numba:
+    quantize step/duration with minimum-grid protection (same as
+    quantize_duration followed by max(grid, ...)), write [pitch, step,
+    duration] into out and shift it into the normalized input window in place.
+    """
+    out[0] = pitch
+    out[1] = max(round(step / grid) * grid, grid)
+    out[2] = max(round(duration / grid) * grid, grid)
+    
+    n = window.shape[0]
+    for r in range(n - 1):
+        for c in range(3):
+            window[r, c] = window[r + 1, c]
+    for c in range(3):
+        window[n - 1, c] = out[c] * inv_norm[c]
+
+
+# Compiled post-step for the per-step loop (None without numba)
+_post_step = njit(cache=True)(_post_step_py) if njit is not None else None
+
+
+def make_generate_fn(
+    model,
+    seq_length: int,
+    vocab_size: int,
+    max_step: float,
+    max_duration: float,
+    grid: float = 0.125,
+    max_notes: Optional[int] = None,
+    jit_compile: bool = False
+):
+    """
+    Build the in-graph generation loop: all autoregressive steps run inside one
+    tf.while_loop (model call + scale-masked sampling + quantization + rolling
+    input update), instead of one Python/Keras round trip per note.
     
-    # Pitch: sample after temperature scaling
-    pitch_logits = predictions['pitch'] / temperature
-    pitch = tf.random.categorical(pitch_logits, num_samples=1)
-    pitch = tf.squeeze(pitch, axis=-1).numpy()[0]
+    Returns a tf.function(seed, total_notes, temperature, scale_bias) producing
+    one float32 (3, N) tensor of rows [pitch, step, duration], so the caller
+    needs a single device->host copy. Steps/durations are quantized but not
+    tempo-scaled: grid multiples are exact in float32, and the caller applies
+    tempo scaling and accumulates start/end times in float64.
     
-    # Step and Duration: use regression output directly
-    step = tf.squeeze(predictions['step'], axis=-1).numpy()[0]
-    duration = tf.squeeze(predictions['duration'], axis=-1).numpy()[0]
+    With max_notes set, outputs have the fixed length max_notes (only the first
+    total_notes entries are filled), so an XLA-compiled loop (jit_compile=True)
+    is compiled once rather than once per note count.
+    """
+    norm = tf.constant([1.0 / vocab_size, 1.0 / max_step, 1.0 / max_duration], tf.float32)
     
-    # Ensure step and duration are non-negative
-    step = max(0, step)
-    duration = max(0, duration)
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec((seq_length, 3), tf.float32),   # Seed sequence (normalized)
+            tf.TensorSpec((), tf.int32),                  # Number of notes to generate
+            tf.TensorSpec((), tf.float32),                # Initial temperature
+            tf.TensorSpec((vocab_size,), tf.float32),     # MusicTheory.get_scale_bias
+        ],
+        jit_compile=jit_compile
+    )
+    def generate(seed, total_notes, temperature, scale_bias):
+        def body(i, notes, temp, pitches, steps, durations):
+            predictions = model(notes[tf.newaxis], training=False)
+            
+            # 1. Sample pitch (temperature scaled, restricted to scale)
+            pitch_logits = tf.cast(predictions['pitch'], tf.float32) / temp + scale_bias
+            pitch = gumbel_max_sample(pitch_logits)[0]
+            
+            # 2. Rhythmic quantization + minimum value protection
+            # (same result as quantize_duration followed by max(grid, ...))
+            step = tf.maximum(tf.cast(predictions['step'][0, 0], tf.float32), 0.0)
+            duration = tf.maximum(tf.cast(predictions['duration'][0, 0], tf.float32), 0.0)
+            step = tf.maximum(tf.round(step / grid) * grid, grid)
+            duration = tf.maximum(tf.round(duration / grid) * grid, grid)
+            
+            pitches = pitches.write(i, pitch)
+            steps = steps.write(i, step)
+            durations = durations.write(i, duration)
+            
+            # 3. Update input sequence with normalized values
+            new_note = tf.stack([tf.cast(pitch, tf.float32), step, duration]) * norm
+            notes = tf.concat([notes[1:], new_note[tf.newaxis]], axis=0)
+            
+            # 4. Dynamic temperature adjustment
+            flip = tf.logical_and(i > 0, i % 16 == 0)
+            temp = tf.where(flip, tf.where(temp > 1.0, 0.9, 1.2), temp)
+            
+            return i + 1, notes, temp, pitches, steps, durations
+        
+        size = total_notes if max_notes is None else max_notes
+        
+        _, _, _, pitches, steps, durations = tf.while_loop(
+            lambda i, *_: i < total_notes,
+            body,
+            loop_vars=(
+                tf.constant(0),
+                seed,
+                temperature,
+                tf.TensorArray(tf.int32, size=size, element_shape=()),
+                tf.TensorArray(tf.float32, size=size, element_shape=()),
+                tf.TensorArray(tf.float32, size=size, element_shape=()),
+            )
+        )
+        
+        return tf.stack([
+            tf.cast(pitches.stack(), tf.float32),
+            steps.stack(),
+            durations.stack(),
+        ])
     
-    return int(pitch), float(step), float(duration)
+    return generate
 
 
 # ============================================================================
@@ -124,6 +320,9 @@ class MusicTheory:
         'blues': [0, 3, 5, 6, 7, 10],     # Blues Scale
     }
     
+    # Sampling logit biases, keyed by (tuple(scale), vocab_size) (see get_scale_bias)
+    _SCALE_BIASES: Dict[tuple, np.ndarray] = {}
+    
     # Genre to scale mapping
     GENRE_SCALE_MAP = {
         'pop': 'major',
@@ -138,6 +337,29 @@ class MusicTheory:
         scale_name = MusicTheory.GENRE_SCALE_MAP.get(genre.lower(), 'major')
         return MusicTheory.SCALES[scale_name]
     
+    @staticmethod
+    def get_scale_mask(scale: List[int], vocab_size: int = 128) -> np.ndarray:
+        """
+        Mask form of a scale: 1.0 for pitches whose pitch class is in scale, else 0.0
+        """
+        pitch_classes = np.arange(vocab_size) % 12
+        return np.isin(pitch_classes, scale).astype(np.float32)
+    
+    @staticmethod
+    def get_scale_bias(scale: List[int], vocab_size: int = 128) -> np.ndarray:
+        """
+        Logit bias form of a scale: 0.0 for in-scale pitches, -1e9 otherwise.
+        Added to the pitch logits before sampling, so only in-scale pitches
+        can be drawn. Cached per scale; the returned array is read-only.
+        """
+        key = (tuple(scale), vocab_size)
+        bias = MusicTheory._SCALE_BIASES.get(key)
+        if bias is None:
+            bias = (MusicTheory.get_scale_mask(scale, vocab_size) - 1.0) * 1e9
+            bias.flags.writeable = False
+            MusicTheory._SCALE_BIASES[key] = bias
+        return bias
+    
     @staticmethod
     def constrain_to_scale(pitch: int, scale: List[int]) -> int:
         """
@@ -154,23 +376,15 @@ class MusicTheory:
             return 60  # Middle C
         
         note = pitch % 12
-        octave = pitch // 12
         
         # If already in scale, return directly
         if note in scale:
             return pitch
         
-        # Find nearest scale note
-        distances = [abs(note - s) for s in scale]
-        min_distance = min(distances)
-        nearest_note = scale[distances.index(min_distance)]
+        # Find nearest scale note (first one on ties)
+        nearest_note = min(scale, key=lambda s: abs(note - s))
         
-        # Handle octave crossing
-        if nearest_note > note and note < 6:
-            # May need to drop to next octave
-            return octave * 12 + nearest_note
-        else:
-            return octave * 12 + nearest_note
+        return (pitch // 12) * 12 + nearest_note
     
     @staticmethod
     def quantize_duration(value: float, grid: float = 0.125) -> float:
@@ -195,6 +409,15 @@ class MusicTheory:
             return grid
         
         return quantized
+    
+    @staticmethod
+    def quantize_duration_vec(values: np.ndarray, grid: float = 0.125) -> np.ndarray:
+        """
+        Vectorized quantize_duration over an array of durations
+        """
+        values = np.asarray(values)
+        quantized = np.where(values <= 0.05, 0.0, np.round(values / grid) * grid)
+        return np.where((quantized == 0) & (values > 0.05), grid, quantized)
 
 
 # ============================================================================
@@ -230,38 +453,71 @@ class SeedGenerator:
         1. First half uses padding (0, 0, 0)
         2. Second half introduces simple musical motif
         3. Use correct normalization
-        """
-        seed = []
         
+        The seed only depends on its arguments, so it is memoized and returned
+        as a read-only array; callers copy it before mutating.
+        """
+        return SeedGenerator._build_seed(
+            genre.lower(), seq_length, vocab_size, float(max_step), float(max_duration)
+        )
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _build_seed(
+        genre: str,
+        seq_length: int,
+        vocab_size: int,
+        max_step: float,
+        max_duration: float
+    ) -> np.ndarray:
         # Get start pitch
-        start_pitch = SeedGenerator.GENRE_START_PITCH.get(genre.lower(), 60)
+        start_pitch = SeedGenerator.GENRE_START_PITCH.get(genre, 60)
         
-        # Build sequence
-        for i in range(seq_length):
-            if i < 15:
-                # First 15: Padding
-                seed.append([0, 0, 0])
-            else:
-                # Last 10: Simple ascending scale
-                offset = i - 15
-                pitch = start_pitch + (offset % 5)  # Simple fifths ascending
-                step = 0.5      # Eighth note
-                duration = 0.4  # Slightly shorter than step
-                
-                # Normalization (Consistent with training)
-                seed.append([
-                    pitch / vocab_size,
-                    step / max_step,
-                    duration / max_duration
-                ])
+        # First 15: Padding (0, 0, 0)
+        seed = np.zeros((seq_length, 3), dtype=np.float32)
+        
+        # Last 10: Simple ascending scale, normalized (Consistent with training)
+        offsets = np.arange(seq_length - 15 if seq_length > 15 else 0) % 5
+        seed[15:, 0] = (start_pitch + offsets) / vocab_size  # Simple fifths ascending
+        seed[15:, 1] = 0.5 / max_step                        # Eighth note
+        seed[15:, 2] = 0.4 / max_duration                    # Slightly shorter than step
         
-        return np.array(seed, dtype=np.float32)
+        seed.flags.writeable = False
+        return seed
 
 
 # ============================================================================
 # 5. MIDI Enhanced Generator
 # ============================================================================
 
+# Accompaniment pattern tables (times are in beats from the start of the bar)
+_CHORDS = np.array([36, 43, 45, 41], dtype=np.int16)  # I - V - vi - IV: C2, G2, A2, F2
+_HAT_TIMES = np.arange(8, dtype=np.float32) / 2       # Eighth notes
+_HAT_VELOCITIES = np.array([85, 60] * 4, dtype=np.int16)
+_KICK_TIMES = np.array([0.0, 2.0, 2.5], dtype=np.float32)
+_KICK_VELOCITIES = np.array([100, 100, 90], dtype=np.int16)
+_SNARE_TIMES = np.array([1.0, 3.0], dtype=np.float32)
+_GHOST_TIME = 3.75
+_FILL_HAT_TIMES = np.arange(6, dtype=np.float32) / 2  # First 3 beats
+_FILL_TIMES = np.array([0.0, 1.0, 2.0, 3.0, 3.25, 3.5, 3.75], dtype=np.float32)
+_FILL_PITCHES = np.array([36, 38, 36, 38, 50, 47, 43], dtype=np.int16)
+_FILL_VELOCITIES = np.array([100, 95, 90, 110, 100, 110, 120], dtype=np.int16)
+
+
+def _encode_varlen(value: int) -> bytes:
+    """Encode a non-negative int as a MIDI variable-length quantity"""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def _midi_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return chunk_type + struct.pack('>I', len(data)) + data
+
+
 class EnhancedMidiGenerator:
     """
     Enhanced MIDI Generator
@@ -277,7 +533,13 @@ class EnhancedMidiGenerator:
     }
     
     # Chord progression (I - V - vi - IV)
-    CHORD_PROGRESSION = [36, 43, 45, 41]  # C2, G2, A2, F2
+    CHORD_PROGRESSION = _CHORDS
+    
+    # MIDI file resolution
+    TICKS_PER_BEAT = 480
+    
+    # Write MIDI bytes directly; False uses symusic / pretty_midi instead
+    USE_NATIVE_WRITER = True
     
     @staticmethod
     def notes_to_midi_base64(
@@ -292,238 +554,321 @@ class EnhancedMidiGenerator:
         1. Multi-track (Melody + Bass + Drums)
         2. Velocity Dynamics
         3. Unified Time Scaling - Solves rhythm misalignment
+        4. Notes collected as per-track arrays and serialized straight to
+           MIDI bytes (symusic / pretty_midi behind USE_NATIVE_WRITER)
         """
         try:
-            import pretty_midi
             import base64
-            import io
-            
-            pm = pretty_midi.PrettyMIDI(initial_tempo=tempo)
-            
-            # --- Unified Time Scaling Factor ---
-            
-            # Assume model raw output is based on 120 BPM (1 beat = 0.5s)
-            # We need to stretch/compress all timestamps based on target Tempo
-            time_scale = 120.0 / max(tempo, 1)
-            
-            # Base beat duration (Quarter note at 120 BPM = 0.5s)
-            base_seconds_per_beat = 0.5
-            # Scaled beat duration
-            seconds_per_beat = base_seconds_per_beat * time_scale
             
-            # ==========================
-            # Track 1: Melody
-            # ==========================
-            
-            program = EnhancedMidiGenerator.INSTRUMENT_MAP.get(genre.lower(), 0)
-            melody_inst = pretty_midi.Instrument(program=program, name="Melody")
-            
-            total_duration = 0.0
-            
-            # Notes here contain already scaled times (processed in generate_with_constraints)
-            # So we don't need to scale start/end again, use directly.
-            
-            for note in notes:
-                # Use directly, do not multiply by time_scale (prevent double scaling)
-                start = note['start']
-                end = note['end']
-                
-                # === Dynamic Velocity ===
-                base_velocity = 100
-                humanize = np.random.randint(-5, 6)
-                
-                # Strong beat accent (calculated based on scaled time)
-                beat_pos = (start / seconds_per_beat) % 4
-                accent = 0
-                if abs(beat_pos - 0) < 0.1:      # First beat
-                    accent = 15
-                elif abs(beat_pos - 2) < 0.1:    # Third beat
-                    accent = 10
-                
-                final_velocity = min(127, max(0, base_velocity + humanize + accent))
-                
-                midi_note = pretty_midi.Note(
-                    velocity=final_velocity,
-                    pitch=int(note['pitch']),
-                    start=start,
-                    end=end
-                )
-                melody_inst.notes.append(midi_note)
-                total_duration = max(total_duration, end)
+            tracks = EnhancedMidiGenerator._build_tracks(notes, tempo, genre)
+            midi_bytes = EnhancedMidiGenerator._write_midi(tracks, tempo)
             
-            pm.instruments.append(melody_inst)
+            return base64.b64encode(midi_bytes).decode('utf-8')
             
-            # ==========================
-            # Track 2: Bass
-            # ==========================
-            
-            bass_inst = pretty_midi.Instrument(program=33, name="Bass")
-            
-            current_time = 0.0
-            bar_index = 0
-            seconds_per_bar = seconds_per_beat * 4
-            
-            while current_time < total_duration:
-                # Get current chord root
-                root_pitch = EnhancedMidiGenerator.CHORD_PROGRESSION[bar_index % 4]
-                
-                # First beat: Long note
-                bass_note1 = pretty_midi.Note(
-                    velocity=90,
-                    pitch=root_pitch,
-                    start=current_time,
-                    end=current_time + seconds_per_beat * 2
-                )
-                bass_inst.notes.append(bass_note1)
-                
-                # Third beat: Repeat
-                if current_time + seconds_per_beat * 2 < total_duration:
-                    bass_note2 = pretty_midi.Note(
-                        velocity=85,
-                        pitch=root_pitch,
-                        start=current_time + seconds_per_beat * 2,
-                        end=current_time + seconds_per_beat * 4
-                    )
-                    bass_inst.notes.append(bass_note2)
-                
-                current_time += seconds_per_bar
-                bar_index += 1
-            
-            pm.instruments.append(bass_inst)
-            
-            # ==========================
-            # Track 3: Drums
-            # ==========================
-            
-            drum_inst = pretty_midi.Instrument(program=0, is_drum=True, name="Drums")
+        except Exception as e:
+            import traceback
+            logger.error(f"Error creating MIDI: {e}")
+            logger.error(traceback.format_exc())
+            return ""
+    
+    @staticmethod
+    def _new_track(name: str, program: int, is_drum: bool = False) -> Dict[str, Any]:
+        return {
+            'name': name,
+            'program': program,
+            'is_drum': is_drum,
+            'pitch': [],
+            'start': [],
+            'end': [],
+            'velocity': [],
+        }
+    
+    @staticmethod
+    def _finalize_track(track: Dict[str, Any]) -> Dict[str, Any]:
+        """Cast track note fields to NumPy arrays of the writer dtypes"""
+        track['pitch'] = np.asarray(track['pitch'], dtype=np.int8)
+        track['start'] = np.asarray(track['start'], dtype=np.float32)
+        track['end'] = np.asarray(track['end'], dtype=np.float32)
+        track['velocity'] = np.asarray(track['velocity'], dtype=np.int8)
+        return track
+    
+    @staticmethod
+    def _build_tracks(
+        notes: List[Dict],
+        tempo: int,
+        genre: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Build Melody / Bass / Drums tracks as note arrays
+        """
+        # --- Unified Time Scaling Factor ---
+        
+        # Assume model raw output is based on 120 BPM (1 beat = 0.5s)
+        # We need to stretch/compress all timestamps based on target Tempo
+        time_scale = 120.0 / max(tempo, 1)
+        
+        # Base beat duration (Quarter note at 120 BPM = 0.5s)
+        base_seconds_per_beat = 0.5
+        # Scaled beat duration
+        seconds_per_beat = base_seconds_per_beat * time_scale
+        inv_seconds_per_beat = 1.0 / seconds_per_beat
+        seconds_per_half_bar = seconds_per_beat * 2
+        seconds_per_bar = seconds_per_beat * 4
+        
+        # ==========================
+        # Track 1: Melody
+        # ==========================
+        
+        program = EnhancedMidiGenerator.INSTRUMENT_MAP.get(genre.lower(), 0)
+        melody_track = EnhancedMidiGenerator._new_track("Melody", program)
+        
+        # Notes here contain already scaled times (processed in generate_with_constraints)
+        # So we don't need to scale start/end again, use directly.
+        n_notes = len(notes)
+        starts = np.fromiter((note['start'] for note in notes), dtype=np.float64, count=n_notes)
+        ends = np.fromiter((note['end'] for note in notes), dtype=np.float64, count=n_notes)
+        
+        # === Dynamic Velocity ===
+        base_velocity = 100
+        humanize = np.random.randint(-5, 6, size=n_notes)
+        
+        # Strong beat accent (calculated based on scaled time)
+        beat_pos = (starts * inv_seconds_per_beat) % 4.0
+        accent = np.where(
+            np.abs(beat_pos - 0) < 0.1, 15,                   # First beat
+            np.where(np.abs(beat_pos - 2) < 0.1, 10, 0)       # Third beat
+        )
+        
+        melody_track['pitch'] = np.fromiter(
+            (note['pitch'] for note in notes), dtype=np.int16, count=n_notes
+        )
+        melody_track['start'] = starts
+        melody_track['end'] = ends
+        melody_track['velocity'] = np.clip(base_velocity + humanize + accent, 0, 127)
+        
+        total_duration = float(ends.max()) if n_notes else 0.0
+        
+        # ==========================
+        # Track 2: Bass
+        # ==========================
+        
+        # Whole-song bar grid computed at once: one row per bar, one column
+        # per hit in the bar pattern, humanization drawn in a single RNG call
+        n_bars = int(np.ceil(total_duration / seconds_per_bar)) if total_duration > 0 else 0
+        bar_index = np.arange(n_bars)
+        bar_starts = bar_index * seconds_per_bar
+        
+        def grid(starts: np.ndarray, beats: np.ndarray) -> np.ndarray:
+            return (starts[:, None] + beats * seconds_per_beat).ravel()
+        
+        bass_track = EnhancedMidiGenerator._new_track("Bass", 33)
+        
+        # Chord root per bar: long note on the first beat, repeated on the third
+        root_pitches = _CHORDS[bar_index % len(_CHORDS)]
+        repeat = bar_starts + seconds_per_half_bar < total_duration
+        bass_track['pitch'] = np.concatenate([root_pitches, root_pitches[repeat]])
+        bass_track['start'] = np.concatenate([bar_starts, bar_starts[repeat] + seconds_per_half_bar])
+        bass_track['end'] = bass_track['start'] + seconds_per_half_bar
+        bass_track['velocity'] = np.concatenate([
+            np.full(n_bars, 90), np.full(int(repeat.sum()), 85)
+        ])
+        
+        # ==========================
+        # Track 3: Drums
+        # ==========================
+        
+        drum_track = EnhancedMidiGenerator._new_track("Drums", 0, is_drum=True)
+        
+        is_fill_bar = (bar_index + 1) % 4 == 0
+        groove_starts = bar_starts[~is_fill_bar]
+        fill_starts = bar_starts[is_fill_bar]
+        
+        # === Standard Groove ===
+        # Hi-hat (Eighth notes, accented on the beat)
+        hat_times = grid(groove_starts, _HAT_TIMES)
+        hat_vels = np.tile(_HAT_VELOCITIES, groove_starts.size)
+        hat_vels = np.clip(hat_vels + np.random.randint(-10, 10, size=hat_times.size), 1, 127)
+        
+        # Kick
+        kick_times = grid(groove_starts, _KICK_TIMES)
+        kick_vels = np.tile(_KICK_VELOCITIES, groove_starts.size)
+        
+        # Snare
+        snare_times = grid(groove_starts, _SNARE_TIMES)
+        snare_vels = 95 + np.random.randint(-5, 5, size=snare_times.size)
+        
+        # Ghost Snare (odd bars)
+        ghost_times = bar_starts[~is_fill_bar & (bar_index % 2 == 1)] + _GHOST_TIME * seconds_per_beat
+        
+        # === Drum Fill ===
+        # Hi-hat (First 3 beats)
+        fill_hat_times = grid(fill_starts, _FILL_HAT_TIMES)
+        fill_hat_vels = np.random.randint(60, 90, size=fill_hat_times.size)
+        
+        # Kick & Snare (First 3 beats) + Fill (4th beat)
+        fill_times = grid(fill_starts, _FILL_TIMES)
+        fill_pitches = np.tile(_FILL_PITCHES, fill_starts.size)
+        fill_vels = np.tile(_FILL_VELOCITIES, fill_starts.size)
+        
+        # Groove hits are cut at the end of the melody, fills always play out
+        groups = [
+            (hat_times, 42, hat_vels, 0.1, True),
+            (kick_times, 36, kick_vels, 0.1, True),
+            (snare_times, 38, snare_vels, 0.1, True),
+            (ghost_times, 38, 50, 0.05, True),
+            (fill_hat_times, 42, fill_hat_vels, 0.1, False),
+            (fill_times, fill_pitches, fill_vels, 0.1, False),
+        ]
+        
+        pitches, starts, ends, velocities = [], [], [], []
+        for times, pitch, velocity, length, clip_to_end in groups:
+            pitch = np.broadcast_to(pitch, times.shape)
+            velocity = np.broadcast_to(velocity, times.shape)
+            if clip_to_end:
+                keep = times < total_duration
+                times, pitch, velocity = times[keep], pitch[keep], velocity[keep]
+            pitches.append(pitch)
+            starts.append(times)
+            ends.append(times + length)
+            velocities.append(velocity)
+        
+        drum_track['pitch'] = np.concatenate(pitches)
+        drum_track['start'] = np.concatenate(starts)
+        drum_track['end'] = np.concatenate(ends)
+        drum_track['velocity'] = np.concatenate(velocities)
+        
+        return [
+            EnhancedMidiGenerator._finalize_track(melody_track),
+            EnhancedMidiGenerator._finalize_track(bass_track),
+            EnhancedMidiGenerator._finalize_track(drum_track),
+        ]
+    
+    @staticmethod
+    def _write_midi(tracks: List[Dict[str, Any]], tempo: int) -> bytes:
+        """
+        Serialize tracks to MIDI bytes (native writer, else symusic if
+        installed, else pretty_midi)
+        """
+        if EnhancedMidiGenerator.USE_NATIVE_WRITER:
+            return EnhancedMidiGenerator._write_midi_fast(tracks, tempo)
+        
+        try:
+            import symusic
+        except ImportError:
+            return EnhancedMidiGenerator._write_midi_pretty(tracks, tempo)
+        
+        score = symusic.Score(EnhancedMidiGenerator.TICKS_PER_BEAT, ttype="second")
+        score.tempos.append(symusic.Tempo(0.0, qpm=tempo, ttype="second"))
+        
+        for track in tracks:
+            sm_track = symusic.Track(
+                name=track['name'],
+                program=track['program'],
+                is_drum=track['is_drum'],
+                ttype="second"
+            )
+            sm_track.notes = symusic.Note.from_numpy(
+                track['start'],
+                track['end'] - track['start'],
+                track['pitch'],
+                track['velocity'],
+                ttype="second"
+            )
+            score.tracks.append(sm_track)
+        
+        return score.dumps_midi()
+    
+    @staticmethod
+    def _write_midi_fast(tracks: List[Dict[str, Any]], tempo: int) -> bytes:
+        """
+        Emit a format-1 Standard MIDI File directly: a tempo track followed by
+        one track per instrument. Note events are sorted and their delta-time
+        varints encoded with array ops instead of per-event Python objects.
+        """
+        ticks_per_beat = EnhancedMidiGenerator.TICKS_PER_BEAT
+        ticks_per_second = ticks_per_beat * tempo / 60.0
+        end_of_track = b'\x00\xff\x2f\x00'
+        
+        # Track 0: tempo (microseconds per quarter note)
+        tempo_track = b'\x00\xff\x51\x03' + struct.pack('>I', int(round(60_000_000 / tempo)))[1:]
+        chunks = [_midi_chunk(b'MTrk', tempo_track + end_of_track)]
+        
+        channel = 0
+        for track in tracks:
+            # Drums go to channel 10; other instruments take channels in order, skipping it
+            if track['is_drum']:
+                track_channel = 9
+            else:
+                track_channel = channel
+                channel += 2 if channel == 8 else 1
             
-            current_time = 0.0
-            bar_index = 0
+            name = track['name'].encode('utf-8')
+            header = (
+                b'\x00\xff\x03' + _encode_varlen(len(name)) + name
+                + bytes([0x00, 0xC0 | track_channel, track['program'] & 0x7F])
+            )
             
-            while current_time < total_duration:
-                is_fill_bar = (bar_index + 1) % 4 == 0
-                
-                if is_fill_bar:
-                    # === Drum Fill ===
-                    # Hi-hat (First 3 beats)
-                    for i in range(6):
-                        hat_time = current_time + i * (seconds_per_beat / 2)
-                        drum_inst.notes.append(pretty_midi.Note(
-                            velocity=np.random.randint(60, 90),
-                            pitch=42,
-                            start=hat_time,
-                            end=hat_time + 0.1
-                        ))
-                    
-                    # Kick & Snare (First 3 beats)
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=100, pitch=36,
-                        start=current_time,
-                        end=current_time + 0.1
-                    ))
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=95, pitch=38,
-                        start=current_time + seconds_per_beat,
-                        end=current_time + seconds_per_beat + 0.1
-                    ))
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=90, pitch=36,
-                        start=current_time + seconds_per_beat * 2,
-                        end=current_time + seconds_per_beat * 2 + 0.1
-                    ))
-                    
-                    # Fill (4th beat)
-                    fill_start = current_time + seconds_per_beat * 3
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=110, pitch=38, start=fill_start, end=fill_start + 0.1
-                    ))
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=100, pitch=50,
-                        start=fill_start + seconds_per_beat * 0.25,
-                        end=fill_start + seconds_per_beat * 0.25 + 0.1
-                    ))
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=110, pitch=47,
-                        start=fill_start + seconds_per_beat * 0.5,
-                        end=fill_start + seconds_per_beat * 0.5 + 0.1
-                    ))
-                    drum_inst.notes.append(pretty_midi.Note(
-                        velocity=120, pitch=43,
-                        start=fill_start + seconds_per_beat * 0.75,
-                        end=fill_start + seconds_per_beat * 0.75 + 0.1
-                    ))
-                    
-                else:
-                    # === Standard Groove ===
-                    # Hi-hat (Eighth notes)
-                    for i in range(8):
-                        hat_time = current_time + i * (seconds_per_beat / 2)
-                        if hat_time >= total_duration:
-                            break
-                        
-                        base_vel = 85 if i % 2 == 0 else 60
-                        vel = base_vel + np.random.randint(-10, 10)
-                        
-                        drum_inst.notes.append(pretty_midi.Note(
-                            velocity=max(1, min(127, vel)),
-                            pitch=42,
-                            start=hat_time,
-                            end=hat_time + 0.1
-                        ))
-                    
-                    # Kick
-                    kick_times = [0, 2, 2.5]
-                    for kt in kick_times:
-                        k_time = current_time + kt * seconds_per_beat
-                        if k_time >= total_duration:
-                            break
-                        vel = 100 if kt % 1 == 0 else 90
-                        drum_inst.notes.append(pretty_midi.Note(
-                            velocity=vel, pitch=36,
-                            start=k_time, end=k_time + 0.1
-                        ))
-                    
-                    # Snare
-                    snare_times = [1, 3]
-                    for st in snare_times:
-                        s_time = current_time + st * seconds_per_beat
-                        if s_time >= total_duration:
-                            break
-                        
-                        drum_inst.notes.append(pretty_midi.Note(
-                            velocity=95 + np.random.randint(-5, 5),
-                            pitch=38,
-                            start=s_time,
-                            end=s_time + 0.1
-                        ))
-                    
-                    # Ghost Snare
-                    if bar_index % 2 == 1:
-                        ghost_time = current_time + 3.75 * seconds_per_beat
-                        if ghost_time < total_duration:
-                            drum_inst.notes.append(pretty_midi.Note(
-                                velocity=50, pitch=38,
-                                start=ghost_time,
-                                end=ghost_time + 0.05
-                            ))
-                
-                current_time += seconds_per_bar
-                bar_index += 1
+            n = len(track['pitch'])
+            # Note-offs (kind 0) sort before note-ons (kind 1) on the same tick
+            ticks = np.round(np.concatenate([track['end'], track['start']]) * ticks_per_second).astype(np.int64)
+            kind = np.repeat(np.array([0, 1], dtype=np.int64), n)
+            order = np.lexsort((kind, ticks))
             
-            pm.instruments.append(drum_inst)
+            ticks = ticks[order]
+            kind = kind[order]
+            pitch = np.tile(np.asarray(track['pitch'], dtype=np.uint8) & 0x7F, 2)[order]
+            velocity = np.concatenate([
+                np.zeros(n, dtype=np.uint8),
+                np.asarray(track['velocity'], dtype=np.uint8) & 0x7F,
+            ])[order]
+            status = np.where(kind == 1, 0x90, 0x80).astype(np.uint8) | track_channel
             
-            # Write to memory
-            buffer = io.BytesIO()
-            pm.write(buffer)
-            buffer.seek(0)
+            # One row per event: up to 4 varint bytes + status, pitch, velocity
+            delta = np.diff(ticks, prepend=0)
+            rows = np.empty((ticks.size, 7), dtype=np.uint8)
+            rows[:, 0] = ((delta >> 21) & 0x7F) | 0x80
+            rows[:, 1] = ((delta >> 14) & 0x7F) | 0x80
+            rows[:, 2] = ((delta >> 7) & 0x7F) | 0x80
+            rows[:, 3] = delta & 0x7F
+            rows[:, 4] = status
+            rows[:, 5] = pitch
+            rows[:, 6] = velocity
             
-            return base64.b64encode(buffer.read()).decode('utf-8')
+            used = np.ones_like(rows, dtype=bool)
+            used[:, 0] = delta >= 1 << 21
+            used[:, 1] = delta >= 1 << 14
+            used[:, 2] = delta >= 1 << 7
             
-        except Exception as e:
-            import traceback
-            logger.error(f"Error creating MIDI: {e}")
-            logger.error(traceback.format_exc())
-            return ""
+            events = rows[used].tobytes()
+            chunks.append(_midi_chunk(b'MTrk', header + events + end_of_track))
+        
+        header_chunk = _midi_chunk(b'MThd', struct.pack('>HHH', 1, len(chunks), ticks_per_beat))
+        return header_chunk + b''.join(chunks)
+    
+    @staticmethod
+    def _write_midi_pretty(tracks: List[Dict[str, Any]], tempo: int) -> bytes:
+        """
+        pretty_midi fallback writer
+        """
+        import pretty_midi
+        import io
+        
+        pm = pretty_midi.PrettyMIDI(initial_tempo=tempo)
+        
+        for track in tracks:
+            inst = pretty_midi.Instrument(
+                program=track['program'], is_drum=track['is_drum'], name=track['name']
+            )
+            inst.notes = [
+                pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(st), end=float(en))
+                for p, st, en, v in zip(track['pitch'], track['start'], track['end'], track['velocity'])
+            ]
+            pm.instruments.append(inst)
+        
+        # Write to memory
+        buffer = io.BytesIO()
+        pm.write(buffer)
+        return buffer.getvalue()
 
 
 # ============================================================================
@@ -547,8 +892,17 @@ class MelodyServiceV2:
     VOCAB_SIZE = 128
     SEQ_LENGTH = 25
     
+    # Compile the sampling graphs with XLA (falls back to a plain graph on failure)
+    USE_XLA = True
+    # Capacity of the XLA-compiled generation loop (API allows up to 32 bars x 6 notes);
+    # longer requests use the per-step loop
+    MAX_NOTES = 192
+    
     def __init__(self):
         self.model = None
+        self._sample_fn = None
+        self._generate_fn = None
+        self._generate_capacity: Optional[int] = None  # None: unbounded (plain graph)
         # Normalization params (will load from file)
         self.max_step = 1.0
         self.max_duration = 1.0
@@ -597,11 +951,134 @@ class MelodyServiceV2:
                 logger.info(f"✓ Loaded normalization params: MAX_STEP={self.max_step:.4f}, MAX_DURATION={self.max_duration:.4f}")
             else:
                 logger.warning("normalization_params.json not found, using defaults (1.0)")
+            
+            # 3. Build graph functions (after params: the generation loop bakes them in)
+            if self.model is not None:
+                self._select_precision()
+                self._sample_fn = self._build_sample_fn()
+                self._generate_fn = self._build_generate_fn()
+                self.warmup()
         
         except Exception as e:
             logger.error(f"Error loading melody model: {e}")
             self.model = None
     
+    def warmup(self, iterations: int = 2):
+        """
+        Run the graph functions on dummy input so tracing / XLA compilation
+        happens at startup instead of on the first user request
+        """
+        dummy_window = tf.zeros((1, self.SEQ_LENGTH, 3), tf.float32)
+        temperature = tf.constant(1.0, tf.float32)
+        scale_bias = tf.zeros((self.vocab_size,), tf.float32)
+        
+        try:
+            for _ in range(iterations):
+                if self._sample_fn is not None:
+                    self._sample_fn(dummy_window, temperature, scale_bias).numpy()
+                if self._generate_fn is not None:
+                    self._generate_fn(
+                        dummy_window[0],
+                        tf.constant(1, tf.int32),
+                        temperature,
+                        scale_bias
+                    ).numpy()
+            
+            # Trigger numba compilation (or load it from the on-disk cache)
+            if _post_step is not None:
+                _post_step(
+                    0, 0.0, 0.0,
+                    0.125,
+                    np.ones(3, dtype=np.float32),
+                    np.zeros((self.SEQ_LENGTH, 3), dtype=np.float32),
+                    np.zeros(3, dtype=np.float64)
+                )
+            logger.info("✓ Melody model warmed up")
+        except Exception as e:
+            logger.warning(f"Melody warm-up failed: {e}")
+    
+    def _select_precision(self):
+        """
+        Pick the inference precision for the device. On GPU, run hidden layers
+        in mixed_float16 (half the weight/activation bandwidth, tensor cores).
+        On CPU fp16 is emulated: the XLA-compiled graphs still handle it well,
+        but a plain graph is much faster in float32.
+        """
+        if tf.config.list_physical_devices('GPU'):
+            self._set_precision('mixed_float16')
+        elif not self.USE_XLA:
+            self._set_precision('float32')
+    
+    def _set_precision(self, policy: str):
+        """
+        Swap self.model for a copy with hidden layers under the given policy
+        """
+        hidden = [
+            layer for layer in self.model.layers
+            if layer.name not in self.model.output_names and layer.weights
+        ]
+        if all(layer.dtype_policy.name == policy for layer in hidden):
+            return
+        
+        try:
+            self.model = clone_with_precision(self.model, policy)
+            logger.info(f"✓ Melody model running with {policy} policy")
+        except Exception as e:
+            logger.warning(f"Could not switch melody model to {policy}, keeping saved precision: {e}")
+    
+    def _build_sample_fn(self):
+        """
+        Build the fused sampler, XLA-compiled when possible. XLA errors only
+        surface on the first call, so compile with a trial input here.
+        """
+        if self.USE_XLA:
+            try:
+                sample_fn = make_sample_fn(
+                    self.model, self.SEQ_LENGTH, self.vocab_size, jit_compile=True
+                )
+                sample_fn(
+                    tf.zeros((1, self.SEQ_LENGTH, 3), tf.float32),
+                    tf.constant(1.0, tf.float32),
+                    tf.zeros((self.vocab_size,), tf.float32)
+                )
+                logger.info("✓ Melody sampler compiled with XLA")
+                return sample_fn
+            except Exception as e:
+                logger.warning(f"XLA compilation failed for melody sampler, using plain graph: {e}")
+                if not tf.config.list_physical_devices('GPU'):
+                    self._set_precision('float32')
+        
+        return make_sample_fn(self.model, self.SEQ_LENGTH, self.vocab_size)
+    
+    def _build_generate_fn(self):
+        """
+        Build the in-graph generation loop, XLA-compiled with a fixed note
+        capacity when possible, else as a plain graph
+        """
+        params = (self.SEQ_LENGTH, self.vocab_size, self.max_step, self.max_duration)
+        
+        if self.USE_XLA:
+            try:
+                generate_fn = make_generate_fn(
+                    self.model, *params, max_notes=self.MAX_NOTES, jit_compile=True
+                )
+                generate_fn(
+                    tf.zeros((self.SEQ_LENGTH, 3), tf.float32),
+                    tf.constant(1, tf.int32),
+                    tf.constant(1.0, tf.float32),
+                    tf.zeros((self.vocab_size,), tf.float32)
+                )
+                logger.info("✓ Melody generation loop compiled with XLA")
+                self._generate_capacity = self.MAX_NOTES
+                return generate_fn
+            except Exception as e:
+                logger.warning(f"XLA compilation failed for melody generation loop, using plain graph: {e}")
+                if not tf.config.list_physical_devices('GPU'):
+                    self._set_precision('float32')
+        
+        self._generate_capacity = None
+        return make_generate_fn(self.model, *params)
+    
     def generate_melody(
         self,
         tempo: int = 120,
@@ -654,7 +1131,7 @@ class MelodyServiceV2:
         
         return {
             "audio_url": audio_url,
-            "notes": notes,
+            **self._notes_to_lanes(notes),
             "tempo": tempo,
             "genre": genre,
             "bars": bars
@@ -670,10 +1147,8 @@ class MelodyServiceV2:
     ) -> List[Dict]:
         """
         Generate melody with constraints
+        Runs the in-graph loop when available, else the per-step Python loop
         """
-        generated_notes = []
-        prev_start = 0.0
-        
         # Get scale for this genre
         scale = MusicTheory.get_scale_for_genre(genre)
         logger.info(f"Using scale for {genre}: {scale}")
@@ -683,58 +1158,137 @@ class MelodyServiceV2:
         # We unify time scaling here.
         tempo_scale = 120.0 / max(tempo, 1) 
         
+        capacity = self._generate_capacity
+        if self._generate_fn is not None and (capacity is None or total_notes <= capacity):
+            try:
+                return self._generate_in_graph(total_notes, input_notes, tempo_scale, scale, temperature)
+            except Exception as e:
+                logger.warning(f"In-graph generation failed, using per-step loop: {e}")
+        
+        return self._generate_stepwise(total_notes, input_notes, tempo_scale, scale, temperature)
+    
+    def _generate_in_graph(
+        self,
+        total_notes: int,
+        input_notes: np.ndarray,
+        tempo_scale: float,
+        scale: List[int],
+        temperature: float
+    ) -> List[Dict]:
+        """
+        Generate all notes with one tf.while_loop call
+        """
+        capacity = self._generate_capacity
+        if capacity is not None and total_notes > capacity:
+            raise ValueError(f"{total_notes} notes exceeds in-graph capacity of {capacity}")
+        
+        result = self._generate_fn(
+            tf.constant(input_notes, dtype=tf.float32),
+            tf.constant(total_notes, dtype=tf.int32),
+            tf.constant(temperature, dtype=tf.float32),
+            tf.constant(MusicTheory.get_scale_bias(scale, self.vocab_size))
+        )
+        
+        # Single device->host copy; outputs may be padded to the loop capacity
+        generated = result.numpy()[:, :total_notes].astype(np.float64)
+        
+        # Tempo scaling + absolute times in float64 (as in _generate_stepwise)
+        steps = generated[1] * tempo_scale
+        durations = generated[2] * tempo_scale
+        starts = np.cumsum(steps)
+        ends = starts + durations
+        
+        generated_notes = [
+            {
+                'pitch': int(pitch),
+                'start': start,
+                'end': end,
+                'step': step,
+                'duration': duration
+            }
+            for pitch, step, duration, start, end in zip(
+                generated[0].tolist(), steps.tolist(), durations.tolist(), starts.tolist(), ends.tolist()
+            )
+        ]
+        
+        logger.info(f"✓ Generated {len(generated_notes)} notes in-graph with tempo scale {tempo_scale:.2f}")
+        return generated_notes
+    
+    def _generate_stepwise(
+        self,
+        total_notes: int,
+        input_notes: np.ndarray,
+        tempo_scale: float,
+        scale: List[int],
+        temperature: float
+    ) -> List[Dict]:
+        """
+        Generate notes one model call at a time
+        """
+        # Key constraint: out-of-scale pitches are masked out of the sampler logits
+        scale_bias = tf.constant(MusicTheory.get_scale_bias(scale, self.vocab_size))
+        
+        # Generated [pitch, step, duration] rows (quantized, not tempo-scaled)
+        generated = np.empty((total_notes, 3), dtype=np.float64)
+        
+        # Rolling input window, shifted in place each step. Kept local (not on
+        # self) so concurrent requests never share a buffer.
+        window = np.array(input_notes, dtype=np.float32)
+        window_view = window[np.newaxis, :, :]
+        inv_norm = np.array(
+            [1.0 / self.vocab_size, 1.0 / self.max_step, 1.0 / self.max_duration],
+            dtype=np.float32
+        )
+        
         # Generation loop
         for i in range(total_notes):
-            # 1. Predict
+            # 1. Predict (pitch is sampled from in-scale pitches only)
             pitch, step, duration = predict_next_note(
-                input_notes[np.newaxis, :, :],
-                self.model,
-                temperature=temperature
+                window_view,
+                self._sample_fn,
+                temperature=temperature,
+                scale_bias=scale_bias
             )
             
-            # 2. Key constraint
-            pitch = MusicTheory.constrain_to_scale(pitch, scale)
-            
-            # 3. Rhythmic quantization
-            step = MusicTheory.quantize_duration(step, grid=0.125)
-            duration = MusicTheory.quantize_duration(duration, grid=0.125)
-            
-            # 4. Minimum value protection
-            step = max(0.125, step)
-            duration = max(0.125, duration)
-            
-            # 5. Apply tempo scaling
-            scaled_step = step * tempo_scale
-            scaled_duration = duration * tempo_scale
-            
-            # 6. Build note object
-            # start/end are accumulated absolute times, already scaled
-            start = prev_start + scaled_step
-            end = start + scaled_duration
-            
-            note_data = {
-                'pitch': int(pitch),
-                'start': float(start),
-                'end': float(end),
-                'step': float(scaled_step),
-                'duration': float(scaled_duration)
-            }
-            generated_notes.append(note_data)
-            
-            # 7. Update input sequence (Note: Input sequence must keep original normalized values!)
-            norm_new_note = [
-                pitch / self.vocab_size,
-                step / self.max_step,
-                duration / self.max_duration
-            ]
-            input_notes = np.vstack([input_notes[1:], norm_new_note])
-            
-            prev_start = start
+            if _post_step is not None:
+                # 2-3. Quantization + input update in one compiled call
+                _post_step(pitch, step, duration, 0.125, inv_norm, window, generated[i])
+            else:
+                generated[i, 0] = pitch
+                
+                # 2. Rhythmic quantization + minimum value protection
+                generated[i, 1:] = np.maximum(
+                    MusicTheory.quantize_duration_vec((step, duration), grid=0.125), 0.125
+                )
+                
+                # 3. Update input sequence (Note: Input sequence must keep original normalized values!)
+                window[:-1] = window[1:]
+                window[-1] = generated[i]
+                window[-1] *= inv_norm
             
-            # 8. Dynamic temperature adjustment
+            # 4. Dynamic temperature adjustment
             if i > 0 and i % 16 == 0:
                 temperature = 0.9 if temperature > 1.0 else 1.2
         
+        # 5. Apply tempo scaling; start/end are accumulated absolute times
+        steps = generated[:, 1] * tempo_scale
+        durations = generated[:, 2] * tempo_scale
+        starts = np.cumsum(steps)
+        ends = starts + durations
+        
+        generated_notes = [
+            {
+                'pitch': int(pitch),
+                'start': start,
+                'end': end,
+                'step': step,
+                'duration': duration
+            }
+            for pitch, step, duration, start, end in zip(
+                generated[:, 0].tolist(), steps.tolist(), durations.tolist(), starts.tolist(), ends.tolist()
+            )
+        ]
+        
         logger.info(f"✓ Generated {len(generated_notes)} notes with tempo scale {tempo_scale:.2f}")
         return generated_notes
     
@@ -775,36 +1329,66 @@ class MelodyServiceV2:
         rhythm = config["rhythm_pattern"]
         durations = config["duration_pattern"]
         
-        notes = []
-        current_time = 0.0
-        prev_pitch = scale[len(scale) // 2]
+        # Neighbor table: scale indices within 5 semitones of each scale pitch
+        scale_arr = np.asarray(scale, dtype=np.int16)
+        neighbors = [np.flatnonzero(np.abs(scale_arr - p) <= 5) for p in scale_arr]
         
-        for i in range(num_notes):
-            # Choose pitch
-            pitch_choices = [p for p in scale if abs(p - prev_pitch) <= 5]
-            if not pitch_choices:
-                pitch_choices = scale
-            pitch = np.random.choice(pitch_choices)
-            
-            # Choose rhythm
-            step = rhythm[i % len(rhythm)]
-            duration = durations[i % len(durations)]
-            
-            # Add random variation
-            step *= np.random.uniform(0.9, 1.1)
-            duration *= np.random.uniform(0.9, 1.1)
-            
-            notes.append({
+        # All randomness drawn up front: pitch picks and rhythm variation
+        rng = np.random.default_rng()
+        picks = rng.random(num_notes)
+        step_jitter = rng.uniform(0.9, 1.1, num_notes)
+        duration_jitter = rng.uniform(0.9, 1.1, num_notes)
+        
+        # Choose pitch: uniform among neighbors of the previous pitch
+        pitch_idx = np.empty(num_notes, dtype=np.intp)
+        prev_idx = len(scale) // 2
+        for i, u in enumerate(picks.tolist()):
+            choices = neighbors[prev_idx]
+            prev_idx = choices[int(u * len(choices))]
+            pitch_idx[i] = prev_idx
+        
+        # Choose rhythm + random variation
+        steps = np.resize(np.asarray(rhythm, dtype=np.float64), num_notes) * step_jitter
+        note_durations = np.resize(np.asarray(durations, dtype=np.float64), num_notes) * duration_jitter
+        start_times = np.cumsum(steps) - steps
+        
+        return [
+            {
                 "pitch": int(pitch),
                 "step": round(step, 3),
                 "duration": round(duration, 3),
-                "start_time": round(current_time, 3)
-            })
-            
-            current_time += step
-            prev_pitch = pitch
+                "start_time": round(start_time, 3)
+            }
+            for pitch, step, duration, start_time in zip(
+                scale_arr[pitch_idx].tolist(),
+                steps.tolist(),
+                note_durations.tolist(),
+                start_times.tolist()
+            )
+        ]
+    
+    @staticmethod
+    def _notes_to_lanes(notes: List[Dict]) -> Dict[str, list]:
+        """
+        Convert list-of-dicts notes into parallel arrays (SoA) for the response
+        """
+        count = len(notes)
+        pitch = np.fromiter((n['pitch'] for n in notes), dtype=np.int64, count=count)
+        step = np.fromiter((n['step'] for n in notes), dtype=np.float64, count=count)
+        duration = np.fromiter((n['duration'] for n in notes), dtype=np.float64, count=count)
+        # Model notes carry absolute 'start', demo notes carry 'start_time'
+        start_time = np.fromiter(
+            (n['start'] if 'start' in n else n['start_time'] for n in notes),
+            dtype=np.float64,
+            count=count
+        )
         
-        return notes
+        return {
+            "pitch": pitch.tolist(),
+            "step": step.tolist(),
+            "duration": duration.tolist(),
+            "start_time": start_time.tolist(),
+        }
     
     def _create_audio(self, notes: List[Dict], tempo: int, genre: str) -> str:
         """
@@ -821,7 +1405,18 @@ class MelodyServiceV2:
 
 
 # ============================================================================
-# Global Service Instance
+# Global Service Instance (model loads lazily on first call)
 # ============================================================================
 
-melody_service = MelodyServiceV2()
+# The lock keeps concurrent first requests from loading the model twice
+_melody_service: Optional[MelodyServiceV2] = None
+_melody_service_lock = threading.Lock()
+
+
+def get_melody_service() -> MelodyServiceV2:
+    global _melody_service
+    if _melody_service is None:
+        with _melody_service_lock:
+            if _melody_service is None:
+                _melody_service = MelodyServiceV2()
+    return _melody_service
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tf2onnx")
+
+from services import classification_service
+from services.classification_service import ClassificationService
+
+BUNDLED_MODEL = os.path.join(classification_service.MODEL_DIR, "song_classification_model.keras")
+
+
+@pytest.mark.skipif(not os.path.exists(BUNDLED_MODEL), reason="bundled classification model not found")
+@pytest.mark.parametrize("int8", [False, True])
+def test_onnx_session_created(tmp_path, monkeypatch, int8):
+    # Export into a scratch model dir so the test never touches models/
+    shutil.copy(BUNDLED_MODEL, tmp_path)
+    monkeypatch.setattr(classification_service, "MODEL_DIR", str(tmp_path))
+    monkeypatch.setattr(ClassificationService, "ONNX_INT8", int8)
+    
+    service = ClassificationService()
+    
+    assert service._sess is not None
+    assert (tmp_path / "song_classification_model.onnx").exists()
+    assert (tmp_path / "song_classification_model.int8.onnx").exists() == int8
+    assert not list(tmp_path.glob("*.tmp.onnx"))
+    
+    specs = service._process_audio(np.random.default_rng(0).standard_normal(service.SONG_SAMPLES).astype(np.float32))
+    expected = service.model.predict(specs, verbose=0)
+    result = service._run_model(specs)
+    
+    assert result.shape == expected.shape
+    assert np.isfinite(result).all()
+    if not int8:
+        np.testing.assert_allclose(result, expected, atol=1e-5)
@@ -82,7 +82,7 @@ export interface MelodyNote {
   pitch: number;
   step: number;
   duration: number;
-  start_time?: number;
+  start_time: number;
 }
 
 export interface MelodyResponse {
@@ -93,6 +93,18 @@ export interface MelodyResponse {
   bars: number;
 }
 
+// Wire format: notes are sent as parallel arrays (one lane per field)
+interface MelodyResponsePayload {
+  audio_url: string;
+  pitch: number[];
+  step: number[];
+  duration: number[];
+  start_time: number[];
+  tempo: number;
+  genre: string;
+  bars: number;
+}
+
 export interface ClassificationResponse {
   top_genre: string;
   confidence: number;
@@ -114,8 +126,18 @@ export async function generateLyrics(params: LyricsRequest): Promise<LyricsRespo
  * Generate melody
  */
 export async function generateMelody(params: MelodyRequest): Promise<MelodyResponse> {
-  const response = await apiClient.post<MelodyResponse>('/api/melody/generate', params);
-  return response.data;
+  const response = await apiClient.post<MelodyResponsePayload>('/api/melody/generate', params);
+  const { pitch, step, duration, start_time, ...rest } = response.data;
+
+  // Zip lanes back into note objects
+  const notes: MelodyNote[] = pitch.map((p, i) => ({
+    pitch: p,
+    step: step[i],
+    duration: duration[i],
+    start_time: start_time[i],
+  }));
+
+  return { ...rest, notes };
 }
 
 /**